@@ -0,0 +1,231 @@
+import argparse, random, selectors, socket, struct, time
+
+# Just enough of the Blackmagic ATEM switcher protocol (UDP 9910) to follow tally: the handshake,
+# acks for the switcher's reliable packets and the TlIn (tally by input) command. client.py --relay
+# uses it to hold the one mixer connection for all M5s. Run as a script it is a stand-in switcher
+# for trying relay mode without a mixer:
+#
+#     python atem.py --inputs 8 --cut-rate 0.5
+#     python client.py --relay 127.0.0.1 --device-port 12012
+#     python simulator.py --count 8 --cut-rate 0 --device-port 12012
+
+ATEM_PORT = 9910
+ATEM_HEADER = struct.Struct('!HHHHHH')  # flags << 11 | length, session, acked id, resend from, unknown, packet id
+COMMAND_HEADER = struct.Struct('!HH4s')  # length including this header, padding, name
+FLAG_RELIABLE = 0x01
+FLAG_HELLO = 0x02
+FLAG_RETRANSMIT = 0x04
+FLAG_ACK = 0x10
+HELLO_CONNECT = 0x01
+HELLO_ACCEPTED = 0x02
+ATEM_RETRY = 1.0  # seconds between hellos while not connected
+ATEM_TIMEOUT = 5.0  # silence from the switcher before the connection counts as lost
+STANDIN_RESEND = 0.2  # seconds before the stand-in resends an unacked packet
+STANDIN_KEEPALIVE = 0.5
+
+
+def packet(flags, session, payload=b'', acked=0, packet_id=0, unknown=0):
+    return ATEM_HEADER.pack(flags << 11 | (ATEM_HEADER.size + len(payload)), session, acked, 0, unknown,
+                            packet_id) + payload
+
+
+def hello(session, code):
+    return packet(FLAG_HELLO, session, bytes([code, 0, 0, 0, 0, 0, 0, 0]), unknown=0x3a)
+
+
+def command(name, body):
+    return COMMAND_HEADER.pack(COMMAND_HEADER.size + len(body), 0, name) + body
+
+
+def commands(payload):
+    # (name, body) for every command in a packet's payload
+    offset = 0
+    while offset + COMMAND_HEADER.size <= len(payload):
+        length, _, name = COMMAND_HEADER.unpack_from(payload, offset)
+        if length < COMMAND_HEADER.size or offset + length > len(payload):
+            return
+        yield name, payload[offset + COMMAND_HEADER.size:offset + length]
+        offset += length
+
+
+def parse_tally(body):
+    # TlIn: input count, then a byte per input with bit 0 program and bit 1 preview -> statuses of inputs 1, 2, ...
+    count, = struct.unpack_from('!H', body)
+    return [2 if flag & 1 else 1 if flag & 2 else 0 for flag in body[2:2 + count]]
+
+
+def tally_command(statuses):
+    return command(b'TlIn', struct.pack('!H', len(statuses)) + bytes(1 if status == 2 else 2 if status == 1 else 0
+                                                                      for status in statuses))
+
+
+class AtemConnection:
+    # The client side, without any I/O: poll() and receive() return the packets to send, so it runs
+    # on whichever thread owns the socket. Reliable packets are taken strictly in order; anything
+    # after a gap is left unacked and the switcher resends it.
+    def __init__(self):
+        self.session = 0
+        self.connected = False
+        self.last_received = 0.0
+        self.last_hello = None
+        self.remote_id = 0
+
+    def next_deadline(self):
+        if self.connected:
+            return self.last_received + ATEM_TIMEOUT
+        return 0.0 if self.last_hello is None else self.last_hello + ATEM_RETRY
+
+    def poll(self, now):
+        if self.connected and now - self.last_received >= ATEM_TIMEOUT:
+            self.connected = False
+        if not self.connected and (self.last_hello is None or now - self.last_hello >= ATEM_RETRY):
+            self.last_hello = now
+            self.session = random.randrange(1, 0x8000)
+            return [hello(self.session, HELLO_CONNECT)]
+        return []
+
+    def ack(self, packet_id):
+        return packet(FLAG_ACK, self.session, acked=packet_id)
+
+    def receive(self, data, now):
+        # -> (packets to send, input statuses if the packet had a TlIn, else None)
+        if len(data) < ATEM_HEADER.size:
+            return [], None
+        word, session, _, _, _, packet_id = ATEM_HEADER.unpack_from(data)
+        flags, length = word >> 11, word & 0x7FF
+        if flags & FLAG_HELLO:
+            # anything but accepted means the switcher is full, the next hello tries again
+            if len(data) > ATEM_HEADER.size and data[ATEM_HEADER.size] == HELLO_ACCEPTED:
+                self.connected = True
+                self.last_received = now
+                self.session = session
+                self.remote_id = packet_id
+                return [self.ack(packet_id)], None
+            return [], None
+        if not self.connected:
+            return [], None
+        self.last_received = now
+        self.session = session  # the switcher moves the session to its own id after the handshake
+        if not flags & FLAG_RELIABLE:
+            return [], None
+        if packet_id != (self.remote_id + 1) & 0x7FFF:
+            # a repeat whose ack got lost is acked again, a packet after a gap waits for the resend
+            repeat = 0 < (self.remote_id - packet_id) & 0x7FFF < 0x4000 or packet_id == self.remote_id
+            return ([self.ack(packet_id)] if repeat else []), None
+        self.remote_id = packet_id
+        tally = None
+        for name, body in commands(data[ATEM_HEADER.size:length]):
+            if name == b'TlIn':
+                tally = parse_tally(body)
+        return [self.ack(packet_id)], tally
+
+
+class StandIn:
+    # A stand-in switcher: accepts any number of clients and cuts between its inputs at random.
+    def __init__(self, options):
+        self.options = options
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((options.host, options.port))
+        self.sock.setblocking(False)
+        self.clients = {}  # address -> {"session", "next_id", "unacked": {id: (packet, sent_at)}, "seen"}
+        self.statuses = [0] * options.inputs
+        self.cuts = 0
+
+    def send(self, data, addr):
+        if random.random() >= self.options.loss:
+            self.sock.sendto(data, addr)
+
+    def send_reliable(self, client, addr, payload, now):
+        packet_id = client["next_id"]
+        client["next_id"] = (packet_id + 1) & 0x7FFF
+        data = packet(FLAG_RELIABLE, client["session"], payload, packet_id=packet_id)
+        client["unacked"][packet_id] = (data, now)
+        self.send(data, addr)
+
+    def receive(self, data, addr, now):
+        if len(data) < ATEM_HEADER.size:
+            return
+        word, _, acked, _, _, _ = ATEM_HEADER.unpack_from(data)
+        flags = word >> 11
+        if flags & FLAG_HELLO:
+            client = self.clients[addr] = {"session": 0x8000 | random.randrange(0x8000), "next_id": 1,
+                                           "unacked": {}, "seen": now}
+            self.send(hello(client["session"], HELLO_ACCEPTED), addr)
+            # the initial state dump, cut down to tally and the "initialization complete" marker
+            self.send_reliable(client, addr, tally_command(self.statuses) + command(b'InCm', b'\x01\x00\x00\x00'), now)
+            return
+        client = self.clients.get(addr)
+        if client is not None:
+            client["seen"] = now
+            if flags & FLAG_ACK:
+                client["unacked"].pop(acked, None)
+
+    def cut(self, now):
+        program, preview = random.sample(range(len(self.statuses)), 2) if len(self.statuses) > 1 else (0, None)
+        self.statuses = [2 if index == program else 1 if index == preview else 0 for index in range(len(self.statuses))]
+        self.cuts += 1
+        for addr, client in self.clients.items():
+            self.send_reliable(client, addr, tally_command(self.statuses), now)
+
+    def maintain(self, now):
+        for addr, client in list(self.clients.items()):
+            if now - client["seen"] > ATEM_TIMEOUT:
+                del self.clients[addr]
+                continue
+            for packet_id, (data, sent_at) in list(client["unacked"].items()):
+                if now - sent_at >= STANDIN_RESEND:
+                    client["unacked"][packet_id] = (data, now)
+                    word, = struct.unpack_from('!H', data)
+                    self.send(struct.pack('!H', word | FLAG_RETRANSMIT << 11) + data[2:], addr)
+            if not client["unacked"]:
+                self.send_reliable(client, addr, b'', now)  # keepalive, like a real switcher's pings
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        end = time.monotonic() + self.options.duration if self.options.duration else None
+        next_cut = time.monotonic() + random.expovariate(self.options.cut_rate) if self.options.cut_rate > 0 else None
+        next_maintain = time.monotonic()
+        while end is None or time.monotonic() < end:
+            due = min(deadline for deadline in (next_cut, next_maintain, end) if deadline is not None)
+            if selector.select(max(0.0, due - time.monotonic())):
+                while True:
+                    try:
+                        data, addr = self.sock.recvfrom(2048)
+                    except BlockingIOError:
+                        break
+                    except OSError:
+                        continue
+                    self.receive(data, addr, time.monotonic())
+            now = time.monotonic()
+            if next_cut is not None and now >= next_cut:
+                self.cut(now)
+                next_cut = now + random.expovariate(self.options.cut_rate)
+            if now >= next_maintain:
+                self.maintain(now)
+                next_maintain = now + min(STANDIN_RESEND, STANDIN_KEEPALIVE)
+        selector.close()
+        self.sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stand-in ATEM switcher that only speaks tally, for testing relay mode")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--port', type=int, default=ATEM_PORT)
+    parser.add_argument('--inputs', type=int, default=8, help="camera inputs to cut between")
+    parser.add_argument('--cut-rate', type=float, default=0.5, help="cuts per second")
+    parser.add_argument('--loss', type=float, default=0.0, help="fraction of outgoing packets to drop")
+    parser.add_argument('--duration', type=float, default=0, help="seconds to run, 0 runs until Ctrl+C")
+    options = parser.parse_args(argv)
+    if not 0 < options.inputs <= 255:
+        parser.error("--inputs must be between 1 and 255")
+    standin = StandIn(options)
+    try:
+        standin.run()
+    except KeyboardInterrupt:
+        pass
+    print(f"{standin.cuts} cuts, {len(standin.clients)} clients connected")
+
+
+if __name__ == '__main__':
+    main()
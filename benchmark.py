@@ -0,0 +1,410 @@
+import argparse, json, multiprocessing, os, platform, random, socket, sys, time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import QTimer, QEventLoop, QT_VERSION_STR
+
+import client, tally
+
+# End-to-end benchmark of client.py. MainWindow runs under Qt's offscreen platform in this process
+# while discovery, status and button datagrams are injected over localhost; results are written as
+# one JSON document.
+#
+#     python benchmark.py --sizes 10 100 500 --output results.json
+#
+# Needs the client ports (12001-12003) free, so don't run it next to a live client.
+
+BENCH_DEVICE_PORT = 12013  # the benchmark receives the connected pings here, not the client's own ports
+POPULATE_CHUNK = 50
+MAX_DEVICES = 255  # device ids are a single byte in beacons and button presses
+HOT_PATHS = (
+    (tally.DatagramHandler, 'handle_discovery'),
+    (tally.DatagramHandler, 'handle_status'),
+    (tally.DatagramHandler, 'handle_button'),
+    (client.DeviceContainer, 'reorder_devices'),
+    (client.DeviceContainer, 'paintEvent'),
+    (client.DeviceTile, 'update_status'),
+    (client.FlashAnimator, 'tick'),
+)
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+    return {"count": len(values), "mean": sum(values) / len(values), "p50": pick(0.50), "p90": pick(0.90),
+            "p99": pick(0.99), "max": values[-1]}
+
+
+def status_packet(device_id, status, sequence, binary):
+    if binary:
+        return tally.build_status(device_id, status, sequence)
+    return json.dumps({"device_id": device_id, "status": status}).encode('utf-8')
+
+
+def blast(host, device_ids, rate, duration, binary, mix, result):
+    # runs in a separate process so the sender's CPU time and GIL don't count against the client;
+    # mix is (status, discovery, button) weights; each pass over the fleet sends one kind, so every
+    # device gets every kind whatever the fleet size
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    kinds = [tally.STATUS_PORT] * mix[0] + [tally.DISCOVERY_PORT] * mix[1] + [tally.BUTTON_PORT] * mix[2]
+    statuses = {device_id: 0 for device_id in device_ids}
+    sent = sequence = 0
+    start = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+        while sent < rate * elapsed:
+            device_id = device_ids[sent % len(device_ids)]
+            port = kinds[(sent // len(device_ids)) % len(kinds)]
+            if port == tally.STATUS_PORT:
+                statuses[device_id] = (statuses[device_id] + 1) % 3
+                sequence += 1
+                payload = status_packet(device_id, statuses[device_id], sequence, binary)
+            else:
+                payload = bytes([device_id])
+            try:
+                sock.sendto(payload, (host, port))
+            except OSError:
+                pass
+            sent += 1
+    result.value = sent
+    sock.close()
+
+
+class MethodTimer:
+    # Wraps methods at class level so every instance is timed, durations in seconds.
+    def __init__(self, targets):
+        self.targets = targets
+        self.originals = {}
+        self.samples = {}
+
+    def install(self):
+        for cls, name in self.targets:
+            original = getattr(cls, name)
+            key = f"{cls.__name__}.{name}"
+            self.originals[(cls, name)] = original
+            self.samples[key] = []
+            setattr(cls, name, self.wrap(original, self.samples[key]))
+
+    def wrap(self, original, samples):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+        return timed
+
+    def uninstall(self):
+        for (cls, name), original in self.originals.items():
+            setattr(cls, name, original)
+
+    def reset(self):
+        for samples in self.samples.values():
+            samples.clear()
+
+    def report(self):
+        return {key: dict(summarize(samples), total=sum(samples)) for key, samples in self.samples.items()}
+
+
+class Benchmark:
+    def __init__(self, app, options):
+        self.app = app
+        self.options = options
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # stands in for every device's listening port, so the connected pings can be timed and counted
+        self.ping_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.ping_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.ping_sock.bind((options.host, BENCH_DEVICE_PORT))
+        self.ping_sock.setblocking(False)
+        self.window = None
+        self.sequence = 0
+        self.awaiting_signal = {}
+        self.awaiting_paint = {}
+        self.awaiting_flash = {}
+        self.signal_latency = []
+        self.paint_latency = []
+        self.flash_latency = []
+        self.timer = MethodTimer(HOT_PATHS)
+
+    def wait(self, timeout, predicate=None):
+        loop = QEventLoop()
+        poll = QTimer()
+        poll.timeout.connect(lambda: predicate is not None and predicate() and loop.quit())
+        poll.start(1)
+        QTimer.singleShot(int(timeout * 1000), loop.quit)
+        loop.exec_()
+        poll.stop()
+        return predicate is None or predicate()
+
+    def open_window(self):
+        width, height = self.options.window
+        self.window = client.MainWindow(device_port=BENCH_DEVICE_PORT, warm_start=False)
+        self.window.setGeometry(0, 0, width, height)
+        # liveness would grey out devices between phases, which isn't what is being measured here
+        self.window.udp_listener.liveness.timeout = 3600
+        self.window.devices_changed.connect(self.on_devices_changed)
+        self.window.show()
+        self.wait(0.2)
+
+    def close_window(self):
+        self.window.close()
+        self.window.deleteLater()
+        self.window = None
+        self.wait(0.1)
+
+    def on_devices_changed(self, changed, online, offline):
+        now = time.perf_counter()
+        for dev_id, ip, status in changed:
+            expected = self.awaiting_signal.get(dev_id)
+            if expected is not None and expected[0] == status:
+                self.signal_latency.append(now - expected[1])
+                del self.awaiting_signal[dev_id]
+
+    def on_paint(self, container, event):
+        now = time.perf_counter()
+        rect = event.rect()
+        for dev_id, (status, sent_at) in list(self.awaiting_paint.items()):
+            tile = container.devices.get(dev_id)
+            if tile is not None and tile.status == status and rect.intersects(tile.rect):
+                self.paint_latency.append(now - sent_at)
+                del self.awaiting_paint[dev_id]
+        for dev_id, sent_at in list(self.awaiting_flash.items()):
+            tile = container.devices.get(dev_id)
+            if tile is not None and tile.highlight > 0 and rect.intersects(tile.rect):
+                self.flash_latency.append(now - sent_at)
+                del self.awaiting_flash[dev_id]
+
+    def install_paint_probe(self):
+        paint = client.DeviceContainer.paintEvent
+        bench = self
+
+        def probed(container, event):
+            paint(container, event)
+            bench.on_paint(container, event)
+
+        client.DeviceContainer.paintEvent = probed
+        return paint
+
+    def device_id(self, index):
+        return index % MAX_DEVICES + 1
+
+    def send_status(self, device_id, status):
+        self.sequence += 1
+        payload = status_packet(device_id, status, self.sequence, self.options.binary)
+        self.sock.sendto(payload, (self.options.host, tally.STATUS_PORT))
+
+    def send_beacon(self, device_id):
+        self.sock.sendto(bytes([device_id]), (self.options.host, tally.DISCOVERY_PORT))
+
+    def press_button(self, device_id):
+        self.sock.sendto(bytes([device_id]), (self.options.host, tally.BUTTON_PORT))
+
+    def received_pings(self):
+        count = 0
+        while True:
+            try:
+                self.ping_sock.recv(1024)
+            except BlockingIOError:
+                return count
+            except OSError:
+                continue
+            count += 1
+
+    def populate(self, count):
+        start = time.perf_counter()
+        registry = self.window.registry
+        device_ids = sorted({self.device_id(index) for index in range(count)})
+        # the devices boot like real M5s, with a beacon each; in chunks, a single burst of hundreds of
+        # datagrams can overflow the socket's receive buffer
+        for first in range(0, len(device_ids), POPULATE_CHUNK):
+            chunk = device_ids[first:first + POPULATE_CHUNK]
+            for device_id in chunk:
+                self.send_beacon(device_id)
+            self.wait(2, lambda: all(str(device_id) in registry for device_id in chunk))
+        wall = self.window.device_container
+        complete = self.wait(10, lambda: len(wall.devices) >= len(device_ids) and wall.layout_from is None)
+        if not complete:
+            raise RuntimeError(f"only {len(wall.devices)} of {len(device_ids)} devices showed up")
+        return {"devices": len(wall.devices), "seconds": time.perf_counter() - start}
+
+    def measure_latency(self, count, samples):
+        self.signal_latency.clear()
+        self.paint_latency.clear()
+        registry = self.window.registry
+        timeouts = 0
+        for _ in range(samples):
+            device_id = self.device_id(random.randrange(count))
+            status = (registry.get(str(device_id)).status + 1) % 3
+            sent_at = time.perf_counter()
+            self.awaiting_signal[str(device_id)] = (status, sent_at)
+            self.awaiting_paint[str(device_id)] = (status, sent_at)
+            self.send_status(device_id, status)
+            if not self.wait(1.0, lambda: not self.awaiting_signal and not self.awaiting_paint):
+                timeouts += 1
+                self.awaiting_signal.clear()
+                self.awaiting_paint.clear()
+            # let the next sample start a fresh flush window instead of joining this one
+            self.wait(tally.STATUS_FLUSH_INTERVAL * 2)
+        return {"packet_to_signal": summarize(self.signal_latency),
+                "packet_to_paint": summarize(self.paint_latency),
+                "timeouts": timeouts}
+
+    def measure_discovery(self, count, samples):
+        # beacon to connected ping, from devices whose last ping is older than ACK_INTERVAL so one is
+        # due; a second beacon right behind it must be swallowed by the ack rate limit
+        registry = self.window.registry
+        device_ids = sorted({self.device_id(index) for index in range(count)})
+        latency = []
+        timeouts = extra_pings = 0
+        self.received_pings()
+        for _ in range(samples):
+            now = time.monotonic()
+            due = [device_id for device_id in device_ids
+                   if now - registry.get(str(device_id)).last_ack > tally.ACK_INTERVAL]
+            if not due:
+                self.wait(tally.ACK_INTERVAL / 4)
+                continue
+            device_id = random.choice(due)
+            sent_at = time.perf_counter()
+            self.send_beacon(device_id)
+            pings = [0]
+
+            def pinged():
+                pings[0] += self.received_pings()
+                return pings[0] > 0
+
+            if self.wait(1.0, pinged):
+                latency.append(time.perf_counter() - sent_at)
+            else:
+                timeouts += 1
+            self.send_beacon(device_id)
+            self.wait(tally.STATUS_FLUSH_INTERVAL * 2)
+            extra_pings += self.received_pings()
+        return {"beacon_to_ping": summarize(latency), "timeouts": timeouts, "rate_limited_pings": extra_pings}
+
+    def measure_button(self, count, samples):
+        # button press to the first frame with the tile's flash lit
+        wall = self.window.device_container
+        timeouts = 0
+        self.flash_latency.clear()
+        for _ in range(samples):
+            device_id = str(self.device_id(random.randrange(count)))
+            wall.devices[device_id].stop_flashing()  # a press while it flashes changes nothing on screen
+            self.wait(tally.STATUS_FLUSH_INTERVAL)
+            self.awaiting_flash[device_id] = time.perf_counter()
+            self.press_button(int(device_id))
+            if not self.wait(1.0, lambda: not self.awaiting_flash):
+                timeouts += 1
+                self.awaiting_flash.clear()
+        return {"button_to_flash": summarize(self.flash_latency), "timeouts": timeouts}
+
+    def processed_packets(self):
+        return sum(self.window.metrics.packets.values())
+
+    def measure_throughput(self, count, rates, duration):
+        device_ids = sorted({self.device_id(index) for index in range(count)})
+        steps = []
+        sustained = 0
+        for rate in rates:
+            self.received_pings()
+            before = self.processed_packets()
+            cpu_before = time.process_time()
+            sent = multiprocessing.Value('q', 0)
+            sender = multiprocessing.Process(target=blast, args=(self.options.host, device_ids, rate, duration,
+                                                                 self.options.binary, self.options.mix, sent))
+            sender.start()
+            self.wait(duration + 0.1, lambda: not sender.is_alive())
+            sender.join()
+            # give the listener and the GUI time to work through what is already queued
+            self.wait(0.5)
+            processed = self.processed_packets() - before
+            cpu = time.process_time() - cpu_before
+            loss = 1 - processed / sent.value if sent.value else 0.0
+            # the ack rate limit caps pings at about one per device per ACK_INTERVAL, however fast they beacon
+            steps.append({"rate": rate, "sent": sent.value, "processed": processed, "loss": loss,
+                          "cpu_per_packet": cpu / processed if processed else None,
+                          "connected_pings": self.received_pings()})
+            if loss <= self.options.max_loss:
+                sustained = max(sustained, sent.value / duration)
+        return {"steps": steps, "sustained_pps": sustained}
+
+    def run_size(self, count):
+        self.timer.reset()
+        self.open_window()
+        try:
+            result = {"devices": count, "populate": self.populate(count)}
+            result["latency"] = self.measure_latency(count, self.options.samples)
+            result["discovery"] = self.measure_discovery(count, self.options.samples)
+            result["button"] = self.measure_button(count, self.options.samples)
+            if self.options.rates:
+                result["throughput"] = self.measure_throughput(count, self.options.rates, self.options.duration)
+            result["hot_paths"] = self.timer.report()
+        finally:
+            self.close_window()
+        return result
+
+    def run(self):
+        self.timer.install()
+        paint = self.install_paint_probe()
+        try:
+            runs = [self.run_size(count) for count in self.options.sizes]
+        finally:
+            client.DeviceContainer.paintEvent = paint
+            self.timer.uninstall()
+            self.ping_sock.close()
+        return {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "qt": QT_VERSION_STR,
+            "qpa": os.environ.get('QT_QPA_PLATFORM'),
+            "options": {key: value for key, value in vars(self.options).items() if key != 'output'},
+            "runs": runs,
+        }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Latency and throughput benchmark for client.py")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 255],
+                        help=f"device counts to test, at most {MAX_DEVICES}")
+    parser.add_argument('--samples', type=int, default=200, help="latency samples per device count")
+    parser.add_argument('--rates', type=int, nargs='*', default=[1000, 5000, 10000, 20000, 50000],
+                        help="packets per second to try for throughput, none to skip")
+    parser.add_argument('--mix', type=int, nargs=3, default=[8, 1, 1], metavar=('STATUS', 'DISCOVERY', 'BUTTON'),
+                        help="share of each kind of packet in the throughput traffic")
+    parser.add_argument('--duration', type=float, default=1.0, help="seconds per throughput step")
+    parser.add_argument('--max-loss', type=float, default=0.01, help="loss allowed for a rate to count as sustained")
+    parser.add_argument('--binary', action='store_true', help="use binary status frames")
+    parser.add_argument('--host', default='127.0.0.1', help="address the client listens on")
+    parser.add_argument('--window', type=int, nargs=2, default=[1920, 1080], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    options = parser.parse_args(argv)
+    if not all(0 < count <= MAX_DEVICES for count in options.sizes):
+        parser.error(f"--sizes must be between 1 and {MAX_DEVICES}, device ids are a single byte")
+    if min(options.mix) < 0 or not sum(options.mix):
+        parser.error("--mix needs non-negative shares, at least one of them above 0")
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    app = QtWidgets.QApplication(sys.argv[:1])
+    results = Benchmark(app, options).run()
+    text = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
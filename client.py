@@ -1,133 +1,301 @@
+import time
+STARTUP_MARKS = [("start", time.perf_counter())]  # for --profile-startup, taken before the imports it times
+
 from PyQt5 import QtGui, QtWidgets
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit,
-                             QPushButton, QMenuBar, QGraphicsOpacityEffect, QMessageBox)
-from PyQt5.QtCore import Qt, QTimer, QSize, QThread, pyqtSignal
-from PyQt5.QtGui import QPixmap, QCursor
-import socket, json, time, subprocess, os
+                             QPushButton, QMenuBar, QMessageBox, QComboBox, QInputDialog)
+from PyQt5.QtCore import Qt, QObject, QTimer, QSize, QRect, QPoint, QThread, pyqtSignal
+from PyQt5.QtGui import QPixmap, QImage, QRegion
+STARTUP_MARKS.append(("import PyQt5", time.perf_counter()))
+import socket, selectors, bisect, functools, itertools, json, threading, os, sys
+from collections import deque, Counter
+
+from tally import (DISCOVERY_PORT, STATUS_PORT, BUTTON_PORT, DEVICE_PORT, STATUS_FLUSH_INTERVAL, MAX_DRAIN,
+                   RATE_INTERVAL, LAG_PROBE_INTERVAL, DEVICE_TIMEOUT, DEVICE_GRACE, DeviceRegistry, DatagramHandler, RegistryView, CaptureWriter, CaptureReplay,
+                   Histogram, serve_metrics, device_key, parse_timeout, save_snapshot, load_snapshot)
+STARTUP_MARKS.append(("import tally and stdlib", time.perf_counter()))
 
 
-cameras = []
 selectedCamera = None
 
+FRAME_INTERVAL = STATUS_FLUSH_INTERVAL  # ~60 Hz
+TILE_SIZE = 100
+MIN_TILE_SIZE = 32
+SPRITE_SOURCE_SIZE = 4 * TILE_SIZE  # sprite files are decoded once and kept at this size, enough for HiDPI tiles
+TILE_SPACING = 0.3  # gap between tallies, relative to the tile size
+FLASH_PERIOD = 0.5  # seconds per bright/dark cycle when a device's button is pressed
+FLASH_COUNT = 4
+METRICS_LOG_INTERVAL = 5.0  # seconds between lines in the --metrics-log file
+GROUPS_FILE = "groups.json"
+PROMPT_HISTORY = 10
+SNAPSHOT_FILE = "devices.json"  # the known devices, so a restart comes back with a full wall
+SNAPSHOT_DELAY = 2.0  # seconds after a change before the snapshot is written, changes in between share the write
+PROFILE_BOUNDS = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+                  0.1, 0.2, 0.5)  # seconds; the hot paths run in microseconds, well below Histogram.BOUNDS
+PROFILE_SAMPLE_SECONDS = 10.0
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between the stack samples
+PROFILE_TOP = 15  # functions listed per thread from a sample
+
 def resource_path(relative_path):
-    try:
-        appdata_path = os.environ.get('APPDATA')
-    except Exception:
-        appdata_path = os.path.abspath(".")  # fallback pentru rulare normala
+    appdata_path = os.environ.get('APPDATA')
+    if not appdata_path:
+        # not installed (running from a checkout, e.g. on Linux): use the files next to this script
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), relative_path)
 
     return os.path.join(os.path.join(appdata_path, "M5TallyClient"), relative_path)
 
-class DeviceWidget(QLabel):
-    device_selected = pyqtSignal(str, str)
 
-    def __init__(self, device_id, ip_address, parent=None):
-        super().__init__(parent)
+def parse_id_list(spec):
+    # "1-8, 12, studio-b/1-4" -> {"1", ..., "8", "12", "studio-b/1", ...}, raises ValueError on anything else
+    ids = set()
+    for part in spec.replace(" ", "").split(","):
+        if not part:
+            continue
+        network, slash, part = part.rpartition("/")
+        first, _, last = part.partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if first < 0 or last < first or last > 0xFFFF:
+            raise ValueError(f"bad device range {part}")
+        ids.update(f"{network}{slash}{device_id}" for device_id in range(first, last + 1))
+    return ids
+
+
+def parse_network(spec):
+    # "studio-b=192.168.2.10:12101,12102,12103" -> ("studio-b", "192.168.2.10", (12101, 12102, 12103))
+    name, _, address = spec.partition("=")
+    host, _, ports = address.partition(":")
+    if not name or "/" in name or not host:
+        raise ValueError(f"bad network {spec}, expected NAME=HOST[:DISCOVERY,STATUS,BUTTON]")
+    ports = tuple(int(port) for port in ports.split(",")) if ports else (DISCOVERY_PORT, STATUS_PORT, BUTTON_PORT)
+    if len(ports) != 3 or len(set(ports)) != 3:
+        raise ValueError(f"bad network {spec}, expected three different ports")
+    return name, host, ports
+
+
+def load_groups():
+    try:
+        with open(resource_path(GROUPS_FILE), encoding='utf-8') as f:
+            groups = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    result = {}
+    for name, spec in groups.items():
+        try:
+            result[name] = (spec, parse_id_list(spec))
+        except (ValueError, AttributeError):
+            continue
+    return result
+
+
+class SpriteCache:
+    # Decoded and scaled once per (status, highlight, size, device pixel ratio), shared by every widget.
+    # The files themselves are decoded on a background thread at startup (QImage, unlike QPixmap, may
+    # be used off the GUI thread), so the first frame doesn't wait for them.
+    def __init__(self, regular_dir="Assets/sprites/default", highlight_dir="Assets/sprites/highlight"):
+        self.regular_dir = regular_dir
+        self.highlight_dir = highlight_dir
+        self.pixmaps = {}
+        self.sources = {}  # path -> QImage at SPRITE_SOURCE_SIZE, null if the file is missing
+
+    def preload(self):
+        paths = [resource_path(f"{self.regular_dir}/{name}.png") for name in ("idle", "preview", "live")]
+        paths += [resource_path(f"{self.highlight_dir}/{name}_pressed.png") for name in ("idle", "preview", "live")]
+        threading.Thread(target=lambda: [self.source(path) for path in paths], daemon=True).start()
+
+    def source(self, path):
+        image = self.sources.get(path)
+        if image is None:
+            # decoded here instead if the preload hasn't got to it yet, whichever finishes first is kept
+            image = QImage(path)
+            if not image.isNull():
+                image = image.scaled(SPRITE_SOURCE_SIZE, SPRITE_SOURCE_SIZE, Qt.KeepAspectRatio,
+                                     Qt.SmoothTransformation)
+            image = self.sources.setdefault(path, image)
+        return image
+
+    def get(self, status, highlight, size, ratio=1.0):
+        key = (status, highlight, size.width(), size.height(), ratio)
+        pixmap = self.pixmaps.get(key)
+        if pixmap is None:
+            pixmap = self.load(status, highlight, size, ratio)
+            self.pixmaps[key] = pixmap
+        return pixmap
+
+    def load(self, status, highlight, size, ratio):
+        status_str = ["idle", "preview", "live"][status] if status in [0, 1, 2] else "idle"
+        if highlight:
+            source = self.source(resource_path(f"{self.highlight_dir}/{status_str}_pressed.png"))
+            if source.isNull():
+                return self.get(status, False, size, ratio)
+        else:
+            source = self.source(resource_path(f"{self.regular_dir}/{status_str}.png"))
+            if source.isNull():
+                source = QImage(100, 100, QImage.Format_RGB32)
+                source.fill(Qt.blue)
+        pixmap = QPixmap.fromImage(source.scaled(size * ratio, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        pixmap.setDevicePixelRatio(ratio)
+        return pixmap
+
+    def set_theme(self, regular_dir, highlight_dir):
+        self.regular_dir = regular_dir
+        self.highlight_dir = highlight_dir
+        self.sources.clear()
+        self.invalidate()
+
+    def invalidate(self):
+        # call after a theme change, or when widgets are resized so stale sizes are not kept around;
+        # only rescales, the decoded files are kept
+        self.pixmaps.clear()
+
+
+sprite_cache = SpriteCache()
+
+
+class DeviceTile:
+    def __init__(self, device_id, ip_address, container):
         self.device_id = device_id
         self.ip_address = ip_address
+        self.container = container
         self.status = 0
         self.active = True
+        self.highlight = 0.0  # 0 shows the regular sprite, 1 the pressed one, in between blends them
         self.flashing = False
-        self.flash_count = 0
-        self.max_flashes = 8
-        self.setFixedSize(100, 100)
-        self.setStyleSheet("border: 3px solid transparent; border-radius: 12px;")
-        self.setAlignment(Qt.AlignCenter)
-        self.setContextMenuPolicy(Qt.CustomContextMenu)
-        self.customContextMenuRequested.connect(self.show_context_menu)
-        self.opacity_effect = QGraphicsOpacityEffect()
-        self.setGraphicsEffect(self.opacity_effect)
-        self.flash_timer = QTimer(self)
-        self.flash_timer.timeout.connect(self.toggle_flash)
-        self.regular_pixmap = None
-        self.bright_pixmap = None
-        self.update_status(0, active=True)
-        self.setCursor(QCursor(Qt.ArrowCursor))
-
-    def mousePressEvent(self, event):
-        if event.button() == Qt.LeftButton:
-            self.device_selected.emit(self.device_id, self.ip_address)
-
-    def paintEvent(self, event):
-        painter = QtGui.QPainter(self)
-        painter.setRenderHint(QtGui.QPainter.Antialiasing)
-        if self.pixmap():
-            painter.drawPixmap(self.rect(), self.pixmap())
-        painter.setPen(Qt.white)
-        painter.setFont(QtGui.QFont('Arial', 22, QtGui.QFont.Bold))
-        painter.drawText(self.rect(), Qt.AlignCenter, str(self.device_id))
+        self.rect = QRect()
 
     def update_status(self, status, active=True):
         self.status = status
         self.active = active
-        status_str = ["idle", "preview", "live"][status] if status in [0, 1, 2] else "idle"
-        regular_sprite_path = resource_path(f"Assets/sprites/default/{status_str}.png")
-        bright_sprite_path = resource_path(f"Assets/sprites/highlight/{status_str}_pressed.png")
-        self.regular_pixmap = QPixmap(regular_sprite_path)
-        if self.regular_pixmap.isNull():
-            self.regular_pixmap = QPixmap(100, 100)
-            self.regular_pixmap.fill(Qt.blue)
-        self.bright_pixmap = QPixmap(bright_sprite_path)
-        if self.bright_pixmap.isNull():
-            self.bright_pixmap = self.regular_pixmap
-        self.setPixmap(self.regular_pixmap.scaled(QSize(100, 100), Qt.KeepAspectRatio))
-        self.opacity_effect.setOpacity(1.0 if active else 0.3)
         self.stop_flashing()
+        self.container.update(self.rect)
 
     def start_flashing(self):
         if not self.flashing and self.active:
-            self.flashing = True
-            self.flash_count = 0
-            self.flash_timer.start(250)
-            self.toggle_flash()
-
-    def toggle_flash(self):
-        if not self.flashing: return
-        self.setPixmap(
-            (self.bright_pixmap if self.flash_count % 2 == 0 else self.regular_pixmap).scaled(QSize(100, 100),
-                                                                                              Qt.KeepAspectRatio))
-        self.flash_count += 1
-        if self.flash_count >= self.max_flashes:
-            self.stop_flashing()
+            self.container.animator.start(self)
 
     def stop_flashing(self):
         if self.flashing:
-            self.flashing = False
-            self.flash_timer.stop()
-            self.setPixmap(self.regular_pixmap.scaled(QSize(100, 100), Qt.KeepAspectRatio))
+            self.container.animator.stop(self)
 
-    def show_context_menu(self, position):
-        context_menu = QtWidgets.QMenu(self)
-        ip_action = context_menu.addAction(self.ip_address)
-        ip_action.setEnabled(False)
-        context_menu.addSeparator()
-        delete_action = context_menu.addAction("Delete Device")
-        action = context_menu.exec_(self.mapToGlobal(position))
-        if action == delete_action:
-            self.parent().remove_device(self.device_id)
+
+class FlashAnimator(QObject):
+    # One timer advances every flashing tile of a container and repaints them as a single region.
+    # It only runs while at least one tile is flashing.
+    def __init__(self, container, period=FLASH_PERIOD, count=FLASH_COUNT, easing=None):
+        super().__init__(container)
+        self.container = container
+        self.flashing = {}
+        self.last_tick = 0.0
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.tick)
+        self.set_pattern(period, count, easing)
+
+    def set_pattern(self, period, count, easing=None):
+        # period: seconds per bright/dark cycle, count: cycles per press,
+        # easing: None for a hard on/off blink, or a QEasingCurve shaping a smooth pulse
+        self.period = period
+        self.count = count
+        self.easing = easing
+        # a hard blink only changes twice per period, a pulse needs a frame-rate tick
+        self.interval = period / 2 if easing is None else FRAME_INTERVAL
+        self.frames = round(period * count / self.interval)
+        if self.timer.isActive():
+            self.timer.setInterval(round(self.interval * 1000))
+
+    def level(self, frame):
+        phase = (frame * self.interval / self.period) % 1.0
+        if self.easing is None:
+            return 1.0 if phase < 0.5 else 0.0
+        return self.easing.valueForProgress(1.0 - abs(2.0 * phase - 1.0))
+
+    def start(self, tile):
+        if self.timer.isActive():
+            # count from the next shared tick so the first frame is never cut short
+            self.flashing[tile] = self.last_tick + self.interval
+        else:
+            self.last_tick = self.flashing[tile] = time.monotonic()
+            self.timer.start(round(self.interval * 1000))
+        tile.flashing = True
+        self.set_level(tile, self.level(0))
+
+    def stop(self, tile):
+        if self.flashing.pop(tile, None) is not None:
+            tile.flashing = False
+            self.set_level(tile, 0.0)
+        if not self.flashing:
+            self.timer.stop()
+
+    def forget(self, tile):
+        self.flashing.pop(tile, None)
+        if not self.flashing:
+            self.timer.stop()
+
+    def set_level(self, tile, level):
+        if tile.highlight != level:
+            tile.highlight = level
+            self.container.update(tile.rect)
+
+    def tick(self):
+        now = self.last_tick = time.monotonic()
+        dirty = QRegion()
+        for tile, started in list(self.flashing.items()):
+            # rounding absorbs timer jitter, a tick that fires a little early still advances the frame
+            frame = max(0, round((now - started) / self.interval))
+            if frame >= self.frames:
+                del self.flashing[tile]
+                tile.flashing = False
+                level = 0.0
+            else:
+                level = self.level(frame)
+            if tile.highlight != level:
+                tile.highlight = level
+                dirty += tile.rect
+        if not dirty.isEmpty():
+            self.container.update(dirty)
+        if not self.flashing:
+            self.timer.stop()
 
 
 class DeviceContainer(QWidget):
+    # Paints every tally itself instead of hosting one QLabel + QGraphicsOpacityEffect per device.
+    device_selected = pyqtSignal(str, str)
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.devices = {}
-        self.layout_ = QHBoxLayout(self)
-        self.layout_.setAlignment(Qt.AlignCenter)
-        self.layout_.setSpacing(30)
+        self.order = []
+        self.order_keys = []  # numeric ids, parallel to self.order, for bisect
+        self.layout_from = None
+        self.tile_size = TILE_SIZE
+        self.tile_spacing = round(TILE_SIZE * TILE_SPACING)
+        self.columns = 1
+        self.origin = QPoint()
+        self.tile_font = None
+        self.animator = FlashAnimator(self)
+        self.setMinimumSize(MIN_TILE_SIZE, MIN_TILE_SIZE)
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(self.show_context_menu)
 
     def add_or_update_device(self, device_id, ip_address, status):
         if device_id in self.devices:
             device = self.devices[device_id]
-            device.active = True
-            device.opacity_effect.setOpacity(1.0)
-            if device.status != status:
+            device.ip_address = ip_address
+            if device.status != status or not device.active:
                 device.update_status(status, active=True)
         else:
-            device_widget = DeviceWidget(device_id, ip_address, self)
-            device_widget.device_selected.connect(self.parent().update_selected_device)
-            device_widget.update_status(status, active=True)
-            self.devices[device_id] = device_widget
-            self.devices[device_id] = device_widget
-            self.reorder_devices()
+            device = DeviceTile(device_id, ip_address, self)
+            device.status = status
+            self.devices[device_id] = device
+            key = device_key(device_id)
+            index = bisect.bisect(self.order_keys, key)
+            self.order_keys.insert(index, key)
+            self.order.insert(index, device_id)
+            self.schedule_layout(index)
+
+    def reactivate_device(self, device_id):
+        device = self.devices.get(device_id)
+        if device is not None and not device.active:
+            device.update_status(device.status, active=True)
 
     def mark_device_inactive(self, device_id):
         if device_id in self.devices:
@@ -137,95 +305,461 @@ class DeviceContainer(QWidget):
         if device_id in self.devices:
             self.devices[device_id].start_flashing()
 
+    def fit_grid(self, count):
+        # largest tile (capped at TILE_SIZE) that fits every device; ties keep the widest row
+        width, height = self.width(), self.height()
+        best_size, best_columns = 0, 1
+        for columns in range(1, max(count, 1) + 1):
+            rows = -(-count // columns)
+            size = min(width / (columns + TILE_SPACING * (columns - 1)),
+                       height / (rows + TILE_SPACING * (rows - 1)) if rows else height,
+                       TILE_SIZE)
+            if size >= best_size:
+                best_size, best_columns = size, columns
+        return max(int(best_size), MIN_TILE_SIZE), best_columns
+
+    def schedule_layout(self, index):
+        # every insert/remove in the same event-loop tick is laid out by one deferred pass
+        if self.layout_from is None:
+            self.layout_from = index
+            QTimer.singleShot(0, self.reorder_devices)
+        else:
+            self.layout_from = min(self.layout_from, index)
+
     def reorder_devices(self):
-        for i in reversed(range(self.layout_.count())):
-            self.layout_.itemAt(i).widget().setParent(None)
-        for key in sorted(self.devices.keys(), key=lambda x: int(x)):
-            self.layout_.addWidget(self.devices[key])
+        if self.layout_from is None:
+            return
+        start, self.layout_from = self.layout_from, None
+        size, columns = self.fit_grid(len(self.order))
+        if size != self.tile_size or self.tile_font is None:
+            self.tile_size = size
+            self.tile_spacing = round(size * TILE_SPACING)
+            self.tile_font = QtGui.QFont('Arial', max(6, round(22 * size / TILE_SIZE)), QtGui.QFont.Bold)
+            sprite_cache.invalidate()
+            start = 0
+        step = self.tile_size + self.tile_spacing
+        rows = -(-len(self.order) // columns)
+        origin = QPoint((self.width() - columns * step + self.tile_spacing) // 2,
+                        (self.height() - rows * step + self.tile_spacing) // 2)
+        if columns != self.columns or origin != self.origin:
+            self.columns, self.origin = columns, origin
+            start = 0
+        # only tiles at or after the first insertion/removal point can have moved
+        for index in range(start, len(self.order)):
+            device = self.devices[self.order[index]]
+            row, column = divmod(index, columns)
+            rect = QRect(origin.x() + column * step, origin.y() + row * step, self.tile_size, self.tile_size)
+            if rect != device.rect:
+                self.update(device.rect)
+                device.rect = rect
+                self.update(rect)
 
     def remove_device(self, device_id):
         if device_id in self.devices:
-            widget = self.devices[device_id]
-            self.layout_.removeWidget(widget)
-            widget.deleteLater()
-            del self.devices[device_id]
+            device = self.devices.pop(device_id)
+            self.animator.forget(device)
+            index = bisect.bisect_left(self.order_keys, device_key(device_id))
+            del self.order_keys[index]
+            del self.order[index]
+            self.update(device.rect)
+            self.schedule_layout(index)
+
+    def device_at(self, pos):
+        step = self.tile_size + self.tile_spacing
+        column = (pos.x() - self.origin.x()) // step
+        row = (pos.y() - self.origin.y()) // step
+        if 0 <= column < self.columns and row >= 0:
+            index = row * self.columns + column
+            if index < len(self.order):
+                device = self.devices[self.order[index]]
+                if device.rect.contains(pos):
+                    return device
+        return None
+
+    def resizeEvent(self, event):
+        self.layout_from = 0
+        self.reorder_devices()
+        super().resizeEvent(event)
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.setPen(Qt.white)
+        painter.setFont(self.tile_font)
+        size = QSize(self.tile_size, self.tile_size)
+        ratio = self.devicePixelRatioF()
+        dirty = event.rect()
+        for device in self.devices.values():
+            if not dirty.intersects(device.rect):
+                continue
+            opacity = 1.0 if device.active else 0.3
+            if device.highlight < 1.0:
+                painter.setOpacity(opacity)
+                painter.drawPixmap(device.rect, sprite_cache.get(device.status, False, size, ratio))
+            if device.highlight > 0.0:
+                painter.setOpacity(opacity * device.highlight)
+                painter.drawPixmap(device.rect, sprite_cache.get(device.status, True, size, ratio))
+            painter.setOpacity(opacity)
+            painter.drawText(device.rect, Qt.AlignCenter, str(device.device_id))
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            device = self.device_at(event.pos())
+            if device is not None:
+                self.device_selected.emit(device.device_id, device.ip_address)
+
+    def show_context_menu(self, position):
+        device = self.device_at(position)
+        if device is None:
+            return
+        context_menu = QtWidgets.QMenu(self)
+        ip_action = context_menu.addAction(device.ip_address)
+        ip_action.setEnabled(False)
+        context_menu.addSeparator()
+        delete_action = context_menu.addAction("Delete Device")
+        action = context_menu.exec_(self.mapToGlobal(position))
+        if action == delete_action:
+            self.remove_device(device.device_id)
 
 
-class UdpListener(QThread):
-    device_signal = pyqtSignal(str, str, int)
-    device_discovered = pyqtSignal(str, str)
-    device_refreshed = pyqtSignal(str, str, int)
+class UdpListener(QThread, DatagramHandler):
+    # One per tally network, each with its own thread, sockets and registry, so a busy studio
+    # can't hold up another one's tallies.
+    devices_changed = pyqtSignal(list, list, list)
     button_pressed = pyqtSignal(str)
+    prompt_state = pyqtSignal(int, str, str, int)  # message id, device id, delivery state, attempts
+    relay_state = pyqtSignal(bool)  # relay mode: connected to the mixer or not
+    message_ids = itertools.count(1)  # shared, so ids stay unique across networks
 
-    def __init__(self):
-        super().__init__()
-        self.running = True
-        self.device_statuses = {}
+    def __init__(self, registry, device_port=DEVICE_PORT, metrics=None, capture=None, replay=None,
+                 host='0.0.0.0', ports=(DISCOVERY_PORT, STATUS_PORT, BUTTON_PORT), namespace='', relay=None):
+        # PyQt passes the keyword arguments QThread doesn't take on to DatagramHandler.__init__
+        super().__init__(registry=registry, metrics=metrics,
+                         clock=replay.now if replay is not None else time.monotonic,
+                         ports=ports, namespace=namespace)
+        registry.subscribe(self.devices_changed.emit)
+        self.host = host
+        self.device_port = device_port
+        self.capture = capture  # path to record every received datagram to
+        self.capture_writer = None
+        self.replay = replay  # a CaptureReplay, fed to the handlers instead of opening sockets
+        self.relay_address = relay  # (host, port) of the mixer whose tally is relayed to the M5s
+        self.atem = None
+        self.atem_sock = None
+        self.relay_connected = False
+        self.thread_ident = None  # so --profile reports can name this thread
+        self.commands = deque()
+        self.stopping = False
+        self.send_sock = None
+        self.send_queue = deque()
+        self.send_blocked = False
+        self.addresses = {}
+        self.selector = selectors.DefaultSelector()
+        # socketpair instead of os.pipe so the wakeup also works with select() on Windows
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
 
-    def send_connected_ping(self, ip):
-        message = {"connected": True}
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(json.dumps(message).encode('utf-8'), (ip, 12002))
-        sock.close()
+    def address_for(self, ip):
+        address = self.addresses.get(ip)
+        if address is None:
+            address = self.addresses[ip] = (ip, self.device_port)
+        return address
 
-    def run(self):
-        s_discovery = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s_status = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s_button = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s_discovery.bind(('0.0.0.0', 12001))
-        s_status.bind(('0.0.0.0', 12002))
-        s_button.bind(('0.0.0.0', 12003))
-        s_discovery.settimeout(0.1)
-        s_status.settimeout(0.1)
-        s_button.settimeout(0.1)
-
-        while self.running:
+    def send_datagram(self, payload, ip):
+        # already on the listener thread, flushed at the end of this loop iteration
+        self.send_queue.append((payload, ip))
+
+    def send_prompt(self, text, device_ids, broadcast=None, message_id=None):
+        # safe from any thread; delivery is tracked on the listener thread and reported via prompt_state
+        if message_id is None:
+            message_id = next(self.message_ids)
+        self.call_soon(self.start_prompt, message_id, text, list(device_ids), broadcast)
+        return message_id
+
+    def button_pressed_by(self, dev_id):
+        self.button_pressed.emit(dev_id)
+
+    def batch_handled(self):
+        # a slot, so it runs on the GUI thread once the batch's queued signal has been delivered
+        self.metrics.batches_handled += 1
+
+    def prompt_updated(self, delivery):
+        self.prompt_state.emit(delivery.message_id, delivery.device_id, delivery.state, delivery.attempts)
+
+    def flush_sends(self):
+        if self.send_sock is None:
+            # replaying, the devices in the capture aren't there to answer
+            self.send_queue.clear()
+            return
+        while self.send_queue:
+            payload, ip = self.send_queue[0]
             try:
-                data, addr = s_discovery.recvfrom(1024)
-                if len(data) == 1:
-                    dev_id = str(data[0])
-                    self.send_connected_ping(addr[0])
-                    if dev_id not in cameras:
-                        cameras.append(dev_id)
-                        self.device_discovered.emit(dev_id, addr[0])
-                    else:
-                        self.device_refreshed.emit(dev_id, addr[0], self.device_statuses.get(dev_id, 0))
-            except socket.timeout:
+                self.send_sock.sendto(payload, self.address_for(ip))
+            except BlockingIOError:
+                if not self.send_blocked:
+                    self.send_blocked = True
+                    self.selector.register(self.send_sock, selectors.EVENT_WRITE, self.flush_sends)
+                return
+            except OSError:
+                # unreachable host and the like, dropped just like a lost UDP packet
                 pass
+            self.send_queue.popleft()
+        if self.send_blocked:
+            self.send_blocked = False
+            self.selector.unregister(self.send_sock)
+
+    def call_soon(self, func, *args):
+        # run func on the listener thread, the only thread allowed to touch the registry and liveness state
+        self.commands.append((func, args))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:
+            pass
+
+    def run_commands(self):
+        try:
+            self.wakeup_recv.recv(4096)
+        except OSError:
+            pass
+        while self.commands:
+            func, args = self.commands.popleft()
+            func(*args)
+
+    def open_sockets(self):
+        sockets = []
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, self.run_commands)
+        if self.replay is not None:
+            return sockets
+        if self.capture is not None:
+            self.capture_writer = CaptureWriter(self.capture)
+        for port, handler in self.handlers.items():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((self.host, port))
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, functools.partial(self.drain, sock, port, handler))
+            sockets.append(sock)
+        self.send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.send_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  # for --prompt-broadcast
+        self.send_sock.bind((self.host, 0))  # pings and prompts leave through this network's interface
+        self.send_sock.setblocking(False)
+        if self.relay_address is not None:
+            self.open_relay()
+        return sockets
+
+    def open_relay(self):
+        from atem import AtemConnection
+        self.atem = AtemConnection()
+        self.atem_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.atem_sock.setblocking(False)
+        self.atem_sock.connect(self.relay_address)
+        self.selector.register(self.atem_sock, selectors.EVENT_READ, self.drain_atem)
+
+    def drain_atem(self):
+        for _ in range(MAX_DRAIN):
             try:
-                data, addr = s_status.recvfrom(1024)
-                message = json.loads(data.decode('utf-8'))
-                dev_id = str(message['device_id'])
-                status = message['status']
-                self.device_signal.emit(dev_id, addr[0], status)
-                self.device_statuses[dev_id] = status
-            except:
-                pass
+                data = self.atem_sock.recv(2048)
+            except BlockingIOError:
+                break
+            except OSError:
+                continue  # port unreachable while the mixer is down, the next hello tries again
+            replies, tally = self.atem.receive(data, time.monotonic())
+            self.send_atem(replies)
+            if tally is not None:
+                self.relay_tally(tally)
+        self.update_relay_state()
+
+    def poll_atem(self):
+        self.send_atem(self.atem.poll(time.monotonic()))
+        self.update_relay_state()
+
+    def send_atem(self, packets):
+        for data in packets:
             try:
-                data, addr = s_button.recvfrom(1024)
-                if len(data) == 1:
-                    self.button_pressed.emit(str(data[0]))
-            except socket.timeout:
+                self.atem_sock.send(data)
+            except OSError:
                 pass
-        s_discovery.close()
-        s_status.close()
-        s_button.close()
+
+    def update_relay_state(self):
+        if self.atem.connected != self.relay_connected:
+            self.relay_connected = self.atem.connected
+            self.relay_state.emit(self.relay_connected)
+
+    def drain(self, sock, port, handler):
+        packets = self.metrics.packets
+        capture = self.capture_writer
+        for _ in range(MAX_DRAIN):
+            try:
+                data, addr = sock.recvfrom(1024)
+            except BlockingIOError:
+                return
+            except OSError:
+                # WSAECONNRESET on Windows after an ICMP port-unreachable, the socket is still usable
+                continue
+            packets[port] += 1
+            if capture is not None:
+                capture.write(time.monotonic(), port, addr, data)
+            handler(data, addr)
+
+    def run(self):
+        self.thread_ident = threading.get_ident()
+        sockets = self.open_sockets()
+        while not self.stopping:
+            deadline = self.next_deadline()
+            if self.atem is not None:
+                deadline = self.atem.next_deadline() if deadline is None else min(deadline, self.atem.next_deadline())
+            capture = self.capture_writer
+            if capture is not None and capture.flush_at is not None:
+                deadline = capture.flush_at if deadline is None else min(deadline, capture.flush_at)
+            if self.replay is not None:
+                due = self.replay.due()
+                wake = deadline if due is None else due if deadline is None else min(deadline, due)
+                timeout = self.replay.delay(wake)
+            else:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                key.data()
+            if self.replay is not None:
+                self.replay.pump(self.deliver, deadline)
+            if self.atem is not None:
+                self.poll_atem()
+            # tick first, so retransmitted prompts and relayed tally go out in this same pass
+            self.tick(self.clock())
+            if capture is not None:
+                capture.tick(time.monotonic())
+            if self.send_queue and not self.send_blocked:
+                self.flush_sends()
+        for sock in sockets:
+            self.selector.unregister(sock)
+            sock.close()
+        if self.send_blocked:
+            self.selector.unregister(self.send_sock)
+        if self.send_sock is not None:
+            self.send_sock.close()
+        if self.atem_sock is not None:
+            self.selector.unregister(self.atem_sock)
+            self.atem_sock.close()
+        if self.capture_writer is not None:
+            self.capture_writer.close()
+        self.selector.unregister(self.wakeup_recv)
 
     def stop(self):
-        self.running = False
+        self.stopping = True
+        self.wakeup()
         self.wait()
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+
+class DiagnosticsPanel(QtWidgets.QDialog):
+    STATUS_NAMES = {0: "off", 1: "preview", 2: "live"}
+
+    def __init__(self, sources, parent=None):
+        super().__init__(parent)
+        self.sources = sources  # (metrics, registry, liveness) per network, the first also has the loop lag
+        self.setWindowTitle("Diagnostics")
+        self.resize(640, 420)
+        layout = QVBoxLayout(self)
+        self.text = QtWidgets.QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        self.text.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        layout.addWidget(self.text)
+        # only refreshed while open, a hidden panel costs nothing
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start(int(RATE_INTERVAL * 1000))
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super().hideEvent(event)
+
+    def refresh(self):
+        lag = self.sources[0][0].loop_lag
+        lines = [f"event loop lag: p50 {lag.quantile(0.5) * 1000:.0f} ms, p99 {lag.quantile(0.99) * 1000:.0f} ms, "
+                 f"max {lag.max * 1000:.1f} ms over {lag.count} probes"]
+        for metrics, registry, liveness in self.sources:
+            snapshot = metrics.snapshot(registry, liveness)
+            width = max([5] + [len(device["device_id"]) + 1 for device in snapshot["devices"]])
+            lines += ["",
+                      (f"network {snapshot['network']}: " if snapshot["network"] else "") +
+                      f"uptime {snapshot['uptime']:.0f} s, signal queue depth {snapshot['signal_queue_depth']}, "
+                      f"stale packets {snapshot['stale_packets']}",
+                      "",
+                      f"{'port':<10}{'packets':>10}{'per s':>10}{'malformed':>11}"]
+            for name, count in snapshot["packets"].items():
+                lines.append(f"{name:<10}{count:>10}{snapshot['packets_per_second'][name]:>10.1f}"
+                             f"{snapshot['malformed'][name]:>11}")
+            lines += ["", f"{'id':<{width}}{'ip':<17}{'status':<9}{'online':<8}{'seen':>8}{'jitter':>9}"
+                          f"{'batt':>6}{'rssi':>6}"]
+            for device in snapshot["devices"]:
+                battery = "-" if device["battery"] is None else device["battery"]
+                rssi = "-" if device["rssi"] is None else device["rssi"]
+                lines.append(f"{device['device_id']:<{width}}{device['ip']:<17}"
+                             f"{self.STATUS_NAMES.get(device['status'], device['status']):<9}"
+                             f"{'yes' if device['online'] else 'no':<8}{device['last_seen']:>7.1f}s"
+                             f"{device['jitter'] * 1000:>7.1f}ms{battery:>6}{rssi:>6}")
+        self.text.setPlainText("\n".join(lines))
 
 
 class MainWindow(QtWidgets.QWidget):
-    def __init__(self):
+    devices_changed = pyqtSignal(list, list, list)
+
+    def __init__(self, device_port=DEVICE_PORT, metrics_port=None, metrics_log=None, capture=None, replay=None,
+                 dashboard_port=None, dashboard_host='127.0.0.1', prompt_broadcast=None, networks=None,
+                 warm_start=True, event_log=None, relay=None, profile=None, profiler=None, device_timeouts=(),
+                 device_grace=None, prompt_acks=()):
         super().__init__()
+        self.profile = profile  # a StartupProfile with --profile-startup
+        self.profiler = profiler  # a HotPathProfiler, already installed, with --profile
+        self.device_port = device_port
+        # (name, bind address, (discovery, status, button ports)) per tally network; one unnamed by default
+        self.networks = networks or [("", '0.0.0.0', (DISCOVERY_PORT, STATUS_PORT, BUTTON_PORT))]
+        self.prompt_broadcast = prompt_broadcast
+        self.device_timeouts = device_timeouts  # (device id or None for all, seconds) from --device-timeout
+        self.device_grace = device_grace
+        self.prompt_acks = prompt_acks  # ids of the devices whose firmware acks prompts, from --prompt-acks
+        self.groups = load_groups()
+        self.prompts = {}  # message id -> (text, {device id: delivery state}), the last PROMPT_HISTORY sent
+        self.dashboard_port = dashboard_port
+        self.dashboard_host = dashboard_host
+        self.dashboard = None
+        self.event_log = event_log  # an eventlog.EventLog, fed from the listener and GUI threads
+        self.relay = relay  # (host, port) of the mixer in relay mode, its tally goes out through the first network
+        self.capture = capture
+        self.replay = replay
+        self.warm_start = warm_start and replay is None  # replayed devices aren't the ones out there now
+        self.metrics_port = metrics_port
+        self.metrics_log = metrics_log
+        self.diagnostics = None
+        self.metrics_server = None
+        self.metrics_file = None
         self.setWindowIcon(QtGui.QIcon(resource_path("Assets/icon.ico")))
         self.setWindowTitle("M5 Device Monitor")
         self.setGeometry(100, 100, 800, 600)
         self.setStyleSheet("background-color: #2E3440; color: #D8DEE9; font-family: 'Fira Code'; font-size: 14px;")
-        self.devices = {}
-        self.initUI()
+        sprite_cache.preload()
+        # the listeners start before any widget exists, so beacons arriving meanwhile are already handled;
+        # what they report is queued to the GUI thread and shown once the event loop runs
         self.start_networking()
+        self.mark("start listeners")
+        self.initUI()
+        self.mark("build widgets")
+        self.show_restored_devices()
+        self.start_diagnostics()
+        self.mark("start diagnostics")
+
+    def mark(self, phase):
+        if self.profile is not None:
+            self.profile.mark(phase)
 
     def initUI(self):
         global selectedCamera
@@ -247,6 +781,21 @@ class MainWindow(QtWidgets.QWidget):
         refresh_action.triggered.connect(self.refresh_devices)
         menu_bar.addAction(refresh_action)
 
+        groups_action = QtWidgets.QAction("Groups", self)
+        groups_action.triggered.connect(self.edit_groups)
+        menu_bar.addAction(groups_action)
+
+        diagnostics_action = QtWidgets.QAction("Diagnostics", self)
+        diagnostics_action.triggered.connect(self.show_diagnostics)
+        menu_bar.addAction(diagnostics_action)
+
+        if self.profiler is not None:
+            profile_menu = menu_bar.addMenu("Profile")
+            profile_menu.addAction("Write Report", self.write_profile)
+            profile_menu.addAction(f"Sample {self.profiler.sample_seconds:g} s", self.profiler.sample)
+            profile_menu.addAction("Reset", self.profiler.reset)
+            self.profiler.sampled.connect(self.write_profile)
+
         about_action = QtWidgets.QAction("About", self)
         about_action.triggered.connect(self.show_about)
         menu_bar.addAction(about_action)
@@ -254,12 +803,19 @@ class MainWindow(QtWidgets.QWidget):
         layout.setMenuBar(menu_bar)
 
         self.device_container = DeviceContainer()
+        self.device_container.device_selected.connect(self.update_selected_device)
         layout.addWidget(self.device_container)
 
         bottom = QHBoxLayout()
         left = QVBoxLayout()
+        target_row = QHBoxLayout()
         self.prompt_label = QLabel("Send Prompt to Device ID: none")
-        left.addWidget(self.prompt_label)
+        target_row.addWidget(self.prompt_label, 1)
+        self.target_box = QComboBox()
+        self.target_box.setStyleSheet("background-color: transparent; color: #D8DEE9; border: 1px solid #D8DEE9;")
+        self.fill_targets()
+        target_row.addWidget(self.target_box)
+        left.addLayout(target_row)
         self.input = QLineEdit()
         self.input.setPlaceholderText("Enter message to send")
         self.input.setStyleSheet(
@@ -270,7 +826,11 @@ class MainWindow(QtWidgets.QWidget):
         self.send_btn.setStyleSheet(
             "background-color: transparent; color: #D8DEE9; padding: 5px; border: 1px solid #D8DEE9; border-radius: 3px;")
         self.send_btn.clicked.connect(self.send_prompt)
-        left.addWidget(self.send_btn)
+        send_row = QHBoxLayout()
+        self.delivery_label = QLabel("")
+        send_row.addWidget(self.delivery_label, 1)
+        send_row.addWidget(self.send_btn)
+        left.addLayout(send_row)
 
         right = QVBoxLayout()
         self.about_label = QLabel("About Device ID: none")
@@ -297,71 +857,270 @@ class MainWindow(QtWidgets.QWidget):
         layout.addLayout(bottom)
 
     def start_networking(self):
-        self.udp_listener = UdpListener()
-        self.udp_listener.device_signal.connect(self.update_device)
-        self.udp_listener.device_discovered.connect(self.add_device)
-        self.udp_listener.device_refreshed.connect(self.refresh_device)
-        self.udp_listener.button_pressed.connect(self.device_flash)
-        self.udp_listener.start()
-        self.cleanup_timer = QTimer(self)
-        self.cleanup_timer.timeout.connect(self.cleanup_devices)
-        self.cleanup_timer.start(10000)
-
-    def add_device(self, dev_id, ip):
-        self.devices[dev_id] = time.time()
-        self.device_container.add_or_update_device(dev_id, ip, 0)
-
-    def refresh_device(self, dev_id, ip, status):
-        self.devices[dev_id] = time.time()
-        self.device_container.add_or_update_device(dev_id, ip, status)
-
-    def update_device(self, dev_id, ip, status):
-        self.devices[dev_id] = time.time()
-        self.device_container.add_or_update_device(dev_id, ip, status)
+        self.devices_changed.connect(self.update_devices)
+        self.listeners = []
+        for name, host, ports in self.networks:
+            listener = UdpListener(DeviceRegistry(), self.device_port, None, self.capture, self.replay,
+                                   host, ports, name + "/" if name else "", None if self.listeners else self.relay)
+            listener.devices_changed.connect(self.devices_changed)
+            listener.devices_changed.connect(listener.batch_handled)
+            listener.button_pressed.connect(self.device_flash)
+            listener.prompt_state.connect(self.update_prompt)
+            listener.relay_state.connect(self.update_relay_state)
+            self.listeners.append(listener)
+        self.udp_listener = self.listeners[0]
+        if self.relay is not None:
+            self.update_relay_state(False)
+        self.metrics = self.udp_listener.metrics  # also holds the GUI-wide event loop lag
+        # the dashboard and the GUI see one merged wall, with namespaced ids from every network
+        self.registry = RegistryView(self.listeners)
+        for listener in self.listeners:
+            listener.prompts.acking.update(device_id for device_id in self.prompt_acks
+                                           if self.registry.handler_for(device_id) is listener)
+            if self.device_grace is not None:
+                listener.liveness.grace = self.device_grace
+            for device_id, seconds in self.device_timeouts:
+                if device_id is None:
+                    listener.liveness.timeout = seconds
+                elif self.registry.handler_for(device_id) is listener:
+                    listener.liveness.set_timeout(device_id, seconds)
+        # restored before the dashboard takes its first snapshot, restore() doesn't notify subscribers
+        self.restored = self.restore_devices() if self.warm_start else []
+        if self.dashboard_port:
+            from dashboard import Dashboard
+            self.dashboard = Dashboard(self.registry, self.registry)
+            try:
+                self.dashboard.start_in_thread(self.dashboard_host, self.dashboard_port)
+                self.registry.subscribe(self.dashboard.publish)
+            except OSError as e:
+                # the tallies matter more than the dashboard, so the client runs on without it
+                self.dashboard = None
+                self.warn(f"The dashboard could not start on port {self.dashboard_port}: {e.strerror or e}")
+        if self.event_log is not None:
+            self.registry.subscribe(self.event_log.record_changes)
+        self.snapshot_timer = QTimer(self)
+        self.snapshot_timer.setSingleShot(True)
+        self.snapshot_timer.timeout.connect(self.save_devices)
+        for listener in self.listeners:
+            listener.start()
+
+    def warn(self, text):
+        # shown once the event loop runs, over the window rather than before it
+        QTimer.singleShot(0, lambda: QMessageBox.warning(self, "M5 Device Monitor", text))
+
+    def restore_devices(self):
+        # last run's devices; the listeners aren't running yet, so their registries can still be written from here
+        offset = time.monotonic() - time.time()
+        restored = []
+        for dev_id, ip, status, last_seen in load_snapshot(resource_path(SNAPSHOT_FILE)):
+            listener = self.registry.handler_for(dev_id)
+            if listener is None or dev_id in listener.registry:
+                continue  # from a network that isn't configured any more
+            listener.registry.restore(dev_id, ip, status, last_seen + offset)
+            restored.append((dev_id, ip, status))
+        return restored
+
+    def show_restored_devices(self):
+        # greyed out until each one checks in again, which the queued online events take care of
+        for dev_id, ip, status in self.restored:
+            self.device_container.add_or_update_device(dev_id, ip, status)
+            self.device_container.mark_device_inactive(dev_id)
+
+    def schedule_snapshot(self):
+        if self.warm_start and not self.snapshot_timer.isActive():
+            self.snapshot_timer.start(int(SNAPSHOT_DELAY * 1000))
+
+    def save_devices(self):
+        offset = time.time() - time.monotonic()
+        devices = []
+        for dev_id in self.device_container.order:
+            record = self.registry.get(dev_id)
+            if record is not None:
+                devices.append((dev_id, record.ip_address, record.status, record.last_seen + offset))
+        try:
+            save_snapshot(resource_path(SNAPSHOT_FILE), devices)
+        except OSError:
+            pass  # a read-only install only loses the warm start
+
+    def metrics_sources(self):
+        return [(listener.metrics, listener.registry, listener.liveness) for listener in self.listeners]
+
+    def start_diagnostics(self):
+        # a late probe means the GUI thread was busy, which is what makes tallies stutter
+        self.lag_probe = QTimer(self)
+        self.lag_probe.setTimerType(Qt.PreciseTimer)
+        self.lag_probe.timeout.connect(self.probe_event_loop)
+        self.lag_expected = time.monotonic() + LAG_PROBE_INTERVAL
+        self.lag_probe.start(int(LAG_PROBE_INTERVAL * 1000))
+        if self.metrics_port:
+            try:
+                self.metrics_server = serve_metrics(self.metrics_sources(), self.metrics_port)
+            except OSError as e:
+                self.warn(f"The metrics endpoint could not start on port {self.metrics_port}: {e.strerror or e}")
+        if self.metrics_log:
+            self.metrics_file = open(self.metrics_log, 'a', encoding='utf-8')
+            self.metrics_timer = QTimer(self)
+            self.metrics_timer.timeout.connect(self.write_metrics)
+            self.metrics_timer.start(int(METRICS_LOG_INTERVAL * 1000))
+
+    def probe_event_loop(self):
+        now = time.monotonic()
+        self.metrics.loop_lag.observe(max(0.0, now - self.lag_expected))
+        self.lag_expected = now + LAG_PROBE_INTERVAL
+        for listener in self.listeners:
+            listener.metrics.sample_rates(now)
+
+    def write_metrics(self):
+        for metrics, registry, liveness in self.metrics_sources():
+            self.metrics_file.write(json.dumps(metrics.snapshot(registry, liveness)) + "\n")
+        self.metrics_file.flush()
+
+    def show_diagnostics(self):
+        if self.diagnostics is None:
+            self.diagnostics = DiagnosticsPanel(self.metrics_sources(), self)
+        self.diagnostics.show()
+        self.diagnostics.raise_()
+
+    def thread_names(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        names[threading.main_thread().ident] = "GUI"
+        for listener in self.listeners:
+            names[listener.thread_ident] = f"listener {listener.namespace.rstrip('/')}".rstrip()
+        return names
+
+    def write_profile(self):
+        try:
+            self.profiler.write(self.thread_names())
+        except OSError:
+            pass  # nowhere to write it, the profile keeps collecting
+
+    def update_devices(self, changed, online, offline):
+        for dev_id, ip, status in changed:
+            self.device_container.add_or_update_device(dev_id, ip, status)
+        for dev_id in online:
+            if dev_id in self.device_container.devices:
+                self.device_container.reactivate_device(dev_id)
+            else:
+                # deleted from the wall earlier, bring it back like a fresh discovery
+                record = self.registry.get(dev_id)
+                self.device_container.add_or_update_device(dev_id, record.ip_address, record.status)
+        for dev_id in offline:
+            self.device_container.mark_device_inactive(dev_id)
+        self.schedule_snapshot()
+
+    def update_relay_state(self, connected):
+        self.setWindowTitle(f"M5 Device Monitor - relaying {self.relay[0]}" if connected else
+                            f"M5 Device Monitor - connecting to mixer {self.relay[0]}")
 
     def device_flash(self, dev_id):
         self.device_container.trigger_device_flash(dev_id)
-
-    def cleanup_devices(self):
-        now = time.time()
-        for dev_id, last_seen in list(self.devices.items()):
-            if now - last_seen > 10:
-                self.device_container.mark_device_inactive(dev_id)
+        if self.event_log is not None:
+            self.event_log.record("button", dev_id)
 
     def refresh_devices(self):
-        for device_id in list(self.devices.keys()):
+        for device_id in list(self.device_container.devices):
             self.device_container.mark_device_inactive(device_id)
+        # forget liveness so every device that checks in again is reported online and reactivated
+        for listener in self.listeners:
+            listener.call_soon(listener.liveness.reset)
 
     def show_about(self):
         QMessageBox.about(self, "About M5 Device Monitor",
                           "This app monitors M5 devices using UDP.\n\nEduard Balasea & Rares-Bogdan Cazan, © 2025")
 
+    def fill_targets(self):
+        current = self.target_box.currentText()
+        self.target_box.clear()
+        self.target_box.addItems(["Selected device", "All devices"] + sorted(self.groups))
+        index = self.target_box.findText(current)
+        self.target_box.setCurrentIndex(max(index, 0))
+
+    def edit_groups(self):
+        text = "\n".join(f"{name}: {spec}" for name, (spec, _) in sorted(self.groups.items()))
+        text, ok = QInputDialog.getMultiLineText(self, "Device Groups",
+                                                 "One group per line, e.g.  handhelds: 1-8, 12", text)
+        if not ok:
+            return
+        groups = {}
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            name, _, spec = line.partition(":")
+            try:
+                if not name.strip():
+                    raise ValueError("missing group name")
+                groups[name.strip()] = (spec.strip(), parse_id_list(spec))
+            except ValueError as e:
+                QMessageBox.warning(self, "Invalid Group", f"{line}\n\n{e}")
+                return
+        self.groups = groups
+        try:
+            with open(resource_path(GROUPS_FILE), 'w', encoding='utf-8') as f:
+                json.dump({name: spec for name, (spec, _) in groups.items()}, f, indent=2)
+        except OSError as e:
+            QMessageBox.warning(self, "Error", f"Could not save groups: {e}")
+        self.fill_targets()
+
     def send_prompt(self):
         global selectedCamera
-        if not selectedCamera:
-            QMessageBox.warning(self, "No Device Selected", "Please click on a device first.")
-            return
-        ip = None
-        for device_id, widget in self.device_container.devices.items():
-            if device_id == selectedCamera:
-                ip = widget.ip_address
-                break
-        if not ip:
-            QMessageBox.warning(self, "IP Not Found", "Could not find IP for selected device.")
+        target = self.target_box.currentIndex()
+        if target == 0:
+            if not selectedCamera:
+                QMessageBox.warning(self, "No Device Selected", "Please click on a device first.")
+                return
+            device_ids = [selectedCamera]
+        elif target == 1:
+            device_ids = list(self.registry.devices)
+        else:
+            device_ids = self.groups[self.target_box.currentText()][1]
+        ips = {record.ip_address for record in map(self.registry.get, device_ids) if record is not None}
+        if not ips:
+            QMessageBox.warning(self, "IP Not Found", "Could not find an IP for any of the target devices.")
             return
         msg = self.input.text()
         if not msg:
             return
-        json_message = {"message": f"{msg}"}
-        json_data = json.dumps(json_message)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            sock.sendto(json_data.encode('utf-8'), (ip, 12002))
-        finally:
-            sock.close()
-        self.about_label.setText(f"About Device ID: {selectedCamera}")
+        # firmware that accepts broadcast prompts gets "All devices" in a single datagram
+        broadcast = self.prompt_broadcast if target == 1 else None
+        by_network = {}
+        for device_id in device_ids:
+            listener = self.registry.handler_for(device_id)
+            if listener is not None:
+                by_network.setdefault(listener, []).append(device_id)
+        # one message id for the whole prompt, whichever networks its devices are on
+        message_id = None
+        for listener, network_ids in by_network.items():
+            message_id = listener.send_prompt(msg, network_ids, broadcast, message_id)
+        self.prompts[message_id] = (msg, {})
+        if self.event_log is not None:
+            self.event_log.record("prompt", id=message_id, text=msg, devices=sorted(device_ids, key=device_key))
+        while len(self.prompts) > PROMPT_HISTORY:
+            del self.prompts[next(iter(self.prompts))]
         self.input.clear()
-        self.ip_label.setText(f"M5 Device IP: {ip}")
+        if target == 0:
+            self.about_label.setText(f"About Device ID: {selectedCamera}")
+            self.ip_label.setText(f"M5 Device IP: {next(iter(ips))}")
+
+    def update_prompt(self, message_id, dev_id, state, attempts):
+        prompt = self.prompts.get(message_id)
+        if prompt is None:
+            return
+        prompt[1][dev_id] = state
+        if self.event_log is not None:
+            self.event_log.record("delivery", dev_id, id=message_id, state=state, attempts=attempts)
+        message_id, (text, states) = next(reversed(self.prompts.items()))
+        counts = {}
+        for device_state in states.values():
+            counts[device_state] = counts.get(device_state, 0) + 1
+        summary = f"{counts.get('delivered', 0)}/{len(states)} delivered"
+        for other in ('retrying', 'failed', 'unconfirmed'):
+            if counts.get(other):
+                summary += f", {counts[other]} {other}"
+        self.delivery_label.setText(f"Prompt {message_id}: {summary}")
+        self.delivery_label.setToolTip("\n".join(
+            f"{message_id} \"{text}\": " + ", ".join(f"{device} {device_state}" for device, device_state in
+                                                   sorted(states.items(), key=lambda item: device_key(item[0])))
+            for message_id, (text, states) in reversed(self.prompts.items())))
 
     def update_selected_device(self, dev_id, ip):
         global selectedCamera
@@ -371,6 +1130,7 @@ class MainWindow(QtWidgets.QWidget):
         self.prompt_label.setText(f"Send Prompt to Device ID: {dev_id}")
 
     def open_flasher(self):
+        import subprocess  # only needed here, kept out of startup
         try:
             flasher_path = resource_path("flasher.exe")            
             if os.path.exists(flasher_path):
@@ -388,20 +1148,289 @@ class MainWindow(QtWidgets.QWidget):
         global selectedCamera
         if selectedCamera and selectedCamera in self.device_container.devices:
             self.device_container.remove_device(selectedCamera)
+            self.schedule_snapshot()
             self.about_label.setText("About Device ID: none")
             self.ip_label.setText("M5 Device IP: unknown")
             self.input.clear()
 
     def closeEvent(self, event):
-        self.udp_listener.stop()
-        self.cleanup_timer.stop()
+        for listener in self.listeners:
+            listener.stop()
+        self.lag_probe.stop()
+        if self.warm_start:
+            self.snapshot_timer.stop()
+            self.save_devices()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        if self.metrics_file is not None:
+            self.metrics_timer.stop()
+            self.write_metrics()
+            self.metrics_file.close()
+        if self.event_log is not None:
+            self.event_log.close()
+        if self.profiler is not None:
+            self.write_profile()
         super().closeEvent(event)
 
 
+class StartupProfile:
+    # --profile-startup: how long each phase from the first import to the first frame took
+    def __init__(self, marks):
+        self.phases = [(phase, end - start) for (_, start), (phase, end) in zip(marks, marks[1:])]
+        self.started = marks[0][1]
+        self.last = marks[-1][1]
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, window, out):
+        for phase, seconds in self.phases:
+            out.write(f"{phase:<26}{seconds * 1000:8.1f} ms\n")
+        out.write(f"{'total':<26}{(self.last - self.started) * 1000:8.1f} ms\n")
+        packets = sum(sum(listener.metrics.packets.values()) for listener in window.listeners)
+        out.write(f"{packets} datagrams handled during startup, {len(window.device_container.devices)} devices shown\n")
+        out.flush()
+
+
+PROFILE_TARGETS = (
+    (UdpListener, 'drain'),  # receive and parse, on the listener threads
+    (DatagramHandler, 'handle_discovery'),
+    (DatagramHandler, 'handle_status'),
+    (DatagramHandler, 'flush_changes'),  # emits devices_changed
+    (MainWindow, 'update_devices'),  # the devices_changed handler, from here on the GUI thread
+    (MainWindow, 'device_flash'),
+    (DeviceContainer, 'add_or_update_device'),
+    (DeviceContainer, 'reorder_devices'),
+    (DeviceContainer, 'paintEvent'),
+    (DeviceTile, 'update_status'),
+)
+
+
+class HotPathProfiler(QObject):
+    # --profile: the hot paths are wrapped at class level before the window exists, so the bound
+    # methods held by the selector, the handler tables and the signals are the timed ones. Each
+    # thread observes into its own histograms, the report adds them up.
+    sampled = pyqtSignal()  # from the sampler thread when a sample is done
+
+    def __init__(self, path, sample_seconds=PROFILE_SAMPLE_SECONDS, targets=PROFILE_TARGETS):
+        super().__init__()
+        self.path = path  # reports are appended here
+        self.sample_seconds = sample_seconds
+        self.targets = targets
+        self.histograms = {}  # (function, thread id) -> Histogram
+        self.since = time.monotonic()
+        self.sampler = None
+        self.last_sample = None  # (seconds, samples taken, {thread id: Counter}, {thread id: Counter})
+
+    def install(self):
+        for cls, name in self.targets:
+            setattr(cls, name, self.wrap(getattr(cls, name), f"{cls.__name__}.{name}"))
+
+    def wrap(self, original, function):
+        histograms = self.histograms
+        perf_counter, get_ident = time.perf_counter, threading.get_ident
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                key = (function, get_ident())
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histogram = histograms[key] = Histogram(PROFILE_BOUNDS)
+                histogram.observe(elapsed)
+        return timed
+
+    def reset(self):
+        self.histograms.clear()
+        self.since = time.monotonic()
+
+    def sample(self):
+        if self.sampler is None or not self.sampler.is_alive():
+            self.sampler = threading.Thread(target=self.run_sampler, args=(self.sample_seconds,), daemon=True)
+            self.sampler.start()
+
+    def run_sampler(self, seconds):
+        # sys._current_frames sees every thread, the QThreads too, where cProfile only sees its own
+        own, total = {}, {}
+        me = threading.get_ident()
+        count = 0
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                own.setdefault(ident, Counter())[(code.co_name, code.co_filename, code.co_firstlineno)] += 1
+                stack = set()  # a recursive function counts once per sample
+                while frame is not None:
+                    code = frame.f_code
+                    stack.add((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                total.setdefault(ident, Counter()).update(stack)
+            count += 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+        self.last_sample = (seconds, count, own, total)
+        self.sampled.emit()
+
+    def report(self, threads):
+        # threads: {thread id: name}
+        lines = [f"== {time.strftime('%Y-%m-%d %H:%M:%S')}, calls over the last {time.monotonic() - self.since:.1f} s"]
+        merged = {}
+        for (function, _), histogram in list(self.histograms.items()):
+            merged.setdefault(function, Histogram(PROFILE_BOUNDS)).merge(histogram)
+        lines.append(f"{'function':<36}{'calls':>9}{'total ms':>11}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}"
+                     f"{'max ms':>10}")
+        for function, histogram in sorted(merged.items(), key=lambda item: -item[1].sum):
+            lines.append(f"{function:<36}{histogram.count:>9}{histogram.sum * 1000:>11.1f}"
+                         f"{histogram.sum / histogram.count * 1000:>10.3f}"
+                         f"{min(histogram.quantile(0.5), histogram.max) * 1000:>10.3f}"
+                         f"{min(histogram.quantile(0.99), histogram.max) * 1000:>10.3f}{histogram.max * 1000:>10.3f}")
+        if self.last_sample is not None:
+            seconds, count, own, total = self.last_sample
+            lines.append(f"sample of {seconds:g} s, {count} stacks per thread; share of samples on top of the "
+                         f"stack (own) and anywhere on it (total)")
+            for ident in sorted(own, key=lambda ident: threads.get(ident, "~")):
+                lines.append(f"  {threads.get(ident, f'thread {ident}')}")
+                for (name, filename, line), hits in own[ident].most_common(PROFILE_TOP):
+                    lines.append(f"    {hits / count:7.1%} own {total[ident][(name, filename, line)] / count:7.1%} "
+                                 f"total  {name} ({os.path.basename(filename)}:{line})")
+        return lines
+
+    def write(self, threads):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write("\n".join(self.report(threads)) + "\n\n")
+
+
 if __name__ == '__main__':
-    import sys
+    STARTUP_MARKS.append(("define classes", time.perf_counter()))
+    import argparse
 
-    app = QtWidgets.QApplication(sys.argv)
-    window = MainWindow()
+    parser = argparse.ArgumentParser(description="M5 Device Monitor")
+    parser.add_argument('--device-port', type=int, default=DEVICE_PORT,
+                        help="port the M5s listen on for pings and prompts (simulator.py uses its own)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve /metrics (Prometheus text) and /metrics.json on this localhost port")
+    parser.add_argument('--metrics-log', help="append a JSON line of metrics to this file every few seconds")
+    parser.add_argument('--dashboard', type=int, metavar='PORT', help="serve a read-only tally page for browsers on this port")
+    parser.add_argument('--dashboard-host', default='127.0.0.1',
+                        help="address for --dashboard, 0.0.0.0 to let phones on the LAN connect")
+    parser.add_argument('--prompt-broadcast', metavar='ADDRESS',
+                        help="send prompts to all devices as one datagram to this broadcast address, e.g. 192.168.1.255")
+    parser.add_argument('--network', action='append', metavar='NAME=HOST[:DISCOVERY,STATUS,BUTTON]',
+                        help="listen for a separate tally network, its device ids shown as NAME/ID; repeat for "
+                             "every studio, e.g. --network a=192.168.1.10 --network b=192.168.2.10")
+    parser.add_argument('--device-timeout', action='append', default=[], metavar='[DEVICE=]SECONDS',
+                        help="silence before a device is shown offline, for all devices or one, e.g. "
+                             f"--device-timeout 5 --device-timeout 3=10 (default {DEVICE_TIMEOUT:g})")
+    parser.add_argument('--device-grace', type=float, metavar='SECONDS',
+                        help=f"slack added to every timeout so one late beacon doesn't flap a tally "
+                             f"(default {DEVICE_GRACE:g})")
+    parser.add_argument('--prompt-acks', metavar='IDS',
+                        help="devices whose firmware acks prompts, e.g. 1-8,studio-b/1-4; their prompts are "
+                             "retransmitted from the first one, the others only once they have acked")
+    parser.add_argument('--no-warm-start', action='store_true',
+                        help="start with an empty wall instead of the devices known from the last run")
+    parser.add_argument('--relay', metavar='MIXER[:PORT]',
+                        help="connect to the ATEM once and send its tally to the M5s, instead of every M5 "
+                             "connecting itself (python atem.py is a stand-in mixer)")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="print how long each startup phase took, up to the first frame")
+    parser.add_argument('--profile', metavar='REPORT',
+                        help="time the network and drawing hot paths; the Profile menu, SIGUSR1 and closing the "
+                             "window append a report to this file, SIGUSR2 takes a sample of every thread's stack")
+    parser.add_argument('--profile-sample', type=float, default=PROFILE_SAMPLE_SECONDS, metavar='SECONDS',
+                        help="how long a --profile stack sample runs")
+    parser.add_argument('--event-log', help="append every tally change, button press and prompt to this file, "
+                                            "query it with eventlog.py")
+    traffic = parser.add_mutually_exclusive_group()
+    traffic.add_argument('--capture', help="record every received datagram to this new capture file")
+    traffic.add_argument('--replay', help="play a capture file back instead of listening on the network")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed, 1 is real time, 0 as fast as possible")
+    parser.add_argument('--replay-from', type=float, default=0.0, help="seconds into the capture to start the replay")
+    options, qt_args = parser.parse_known_args()
+    profile = StartupProfile(STARTUP_MARKS) if options.profile_startup else None
+    if profile is not None:
+        profile.mark("parse arguments")
+    networks = None
+    if options.network:
+        try:
+            networks = [parse_network(spec) for spec in options.network]
+        except ValueError as e:
+            parser.error(str(e))
+        if len({name for name, _, _ in networks}) != len(networks):
+            parser.error("every --network needs its own name")
+        if len(networks) > 1 and (options.capture or options.replay or options.prompt_broadcast or options.relay):
+            parser.error("--capture, --replay, --prompt-broadcast and --relay work with a single network only")
+    try:
+        device_timeouts = [parse_timeout(spec) for spec in options.device_timeout]
+    except ValueError as e:
+        parser.error(str(e))
+    if options.device_grace is not None and options.device_grace < 0:
+        parser.error("--device-grace can't be negative")
+    prompt_acks = set()
+    if options.prompt_acks:
+        try:
+            prompt_acks = parse_id_list(options.prompt_acks)
+        except ValueError as e:
+            parser.error(f"bad --prompt-acks: {e}")
+    if options.capture and os.path.exists(options.capture):
+        parser.error(f"{options.capture} already exists, captures are never overwritten")
+    replay = None
+    if options.replay:
+        try:
+            replay = CaptureReplay(options.replay, options.speed, options.replay_from)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    relay = None
+    if options.relay:
+        if options.replay:
+            parser.error("--relay needs the live network, not a --replay")
+        from atem import ATEM_PORT
+        host, _, port = options.relay.partition(":")
+        try:
+            relay = (host, int(port) if port else ATEM_PORT)
+        except ValueError:
+            parser.error(f"bad --relay port {port}")
+    event_log = None
+    if options.event_log:
+        from eventlog import EventLog
+        try:
+            event_log = EventLog(options.event_log)
+        except OSError as e:
+            parser.error(str(e))
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    if profile is not None:
+        profile.mark("create QApplication")
+    profiler = None
+    if options.profile:
+        # installed before the window, whose listeners and signals take their bound methods at creation
+        profiler = HotPathProfiler(options.profile, options.profile_sample)
+        profiler.install()
+    window = MainWindow(device_port=options.device_port, metrics_port=options.metrics_port,
+                        metrics_log=options.metrics_log, capture=options.capture, replay=replay,
+                        dashboard_port=options.dashboard, dashboard_host=options.dashboard_host,
+                        prompt_broadcast=options.prompt_broadcast, networks=networks,
+                        warm_start=not options.no_warm_start, event_log=event_log, relay=relay,
+                        device_timeouts=device_timeouts, device_grace=options.device_grace, prompt_acks=prompt_acks,
+                        profile=profile, profiler=profiler)
+    if profiler is not None:
+        import signal
+        if hasattr(signal, 'SIGUSR1'):
+            # the handlers run between bytecodes on the GUI thread, which the lag probe wakes at least every
+            # LAG_PROBE_INTERVAL; the work is left to the event loop
+            signal.signal(signal.SIGUSR1, lambda *_: QTimer.singleShot(0, window.write_profile))
+            signal.signal(signal.SIGUSR2, lambda *_: QTimer.singleShot(0, profiler.sample))
     window.show()
+    if profile is not None:
+        profile.mark("show window")
+        app.processEvents()  # the first frame, including the queued device updates
+        profile.mark("first frame")
+        profile.report(window, sys.stderr)
     sys.exit(app.exec_())
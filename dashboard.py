@@ -0,0 +1,162 @@
+import asyncio, json, threading
+
+# Read-only tally dashboard for phones and other browsers, served by client.py --dashboard or
+# monitor.py --dashboard. Viewers get the whole state once as a server-sent event, then only diffs.
+# Every change is serialized a single time and the same bytes are queued to all viewers.
+
+MAX_VIEWER_BUFFER = 256 * 1024  # bytes queued for one viewer before it is dropped as too slow
+KEEPALIVE_INTERVAL = 15.0  # seconds between SSE comments, so phones and proxies keep the stream open
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">
+<title>M5 Tally</title>
+<style>
+body { background: #2E3440; color: #D8DEE9; font-family: sans-serif; margin: 8px; }
+#wall { display: grid; grid-template-columns: repeat(auto-fill, minmax(80px, 1fr)); gap: 8px; }
+.tile { border-radius: 8px; padding: 18px 0; text-align: center; font-size: 28px; font-weight: bold; background: #4C566A; }
+.s1 { background: #3FA34D; } .s2 { background: #D33F49; } .offline { opacity: 0.3; }
+#state { font-size: 12px; margin-top: 8px; }
+</style></head>
+<body><div id="wall"></div><div id="state">connecting</div>
+<script>
+const devices = {};
+function render() {
+  const wall = document.getElementById("wall");
+  wall.textContent = "";
+  for (const id of Object.keys(devices).sort((a, b) => a.localeCompare(b, undefined, {numeric: true}))) {
+    const device = devices[id], tile = document.createElement("div");
+    tile.className = "tile s" + device.status + (device.online ? "" : " offline");
+    tile.textContent = id;
+    tile.title = device.ip;
+    wall.appendChild(tile);
+  }
+}
+function apply(event) {
+  const message = JSON.parse(event.data);
+  if (event.type === "snapshot") for (const id of Object.keys(devices)) delete devices[id];
+  Object.assign(devices, message.devices);
+  render();
+}
+const source = new EventSource("events");
+source.addEventListener("snapshot", apply);
+source.addEventListener("diff", apply);
+source.onopen = () => document.getElementById("state").textContent = "live";
+source.onerror = () => document.getElementById("state").textContent = "reconnecting";
+</script></body></html>
+"""
+
+
+class Dashboard:
+    def __init__(self, registry, liveness):
+        self.registry = registry
+        self.liveness = liveness
+        self.devices = {}
+        self.version = 0
+        self.snapshot_event = None  # serialized lazily, once per version
+        self.viewers = set()
+        self.loop = None
+        self.server = None
+
+    def publish(self, changed, online, offline):
+        # registry subscriber, runs on the registry's writer thread where reading it is safe
+        updates = {}
+        for dev_id, ip, status in changed:
+            updates[dev_id] = {"ip": ip, "status": status, "online": self.liveness.is_online(dev_id)}
+        for dev_id in list(online) + list(offline):
+            record = self.registry.get(dev_id)
+            if record is not None:
+                updates[dev_id] = {"ip": record.ip_address, "status": record.status,
+                                   "online": self.liveness.is_online(dev_id)}
+        if updates and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.apply, updates)
+
+    def apply(self, updates):
+        updates = {dev_id: state for dev_id, state in updates.items() if self.devices.get(dev_id) != state}
+        if not updates:
+            return
+        self.devices.update(updates)
+        self.version += 1
+        self.snapshot_event = None
+        self.broadcast(self.event("diff", updates))
+
+    def event(self, name, devices):
+        return f"event: {name}\ndata: {json.dumps({'version': self.version, 'devices': devices})}\n\n".encode('utf-8')
+
+    def snapshot(self):
+        if self.snapshot_event is None:
+            self.snapshot_event = self.event("snapshot", self.devices)
+        return self.snapshot_event
+
+    def broadcast(self, data):
+        for writer in list(self.viewers):
+            if writer.transport.get_write_buffer_size() > MAX_VIEWER_BUFFER:
+                self.viewers.discard(writer)
+                writer.close()
+            else:
+                writer.write(data)
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            self.broadcast(b": keepalive\n\n")
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        parts = request.split(b" ", 2)
+        path = parts[1].decode('latin-1').split("?")[0] if len(parts) > 2 and parts[0] == b"GET" else None
+        if path == "/events":
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                         b"Connection: keep-alive\r\n\r\n" + self.snapshot())
+            self.viewers.add(writer)
+            try:
+                # viewers never send anything more, reading only notices when they go away
+                while await reader.read(1024):
+                    pass
+            except ConnectionError:
+                pass
+            self.viewers.discard(writer)
+        elif path in ("/", "/index.html"):
+            self.respond(writer, "200 OK", "text/html; charset=utf-8", PAGE.encode('utf-8'))
+        elif path == "/state.json":
+            body = json.dumps({"version": self.version, "devices": self.devices}).encode('utf-8')
+            self.respond(writer, "200 OK", "application/json", body)
+        else:
+            self.respond(writer, "404 Not Found", "text/plain", b"not found\n")
+        writer.close()
+
+    def respond(self, writer, status, content_type, body):
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode('latin-1') + body)
+
+    async def start(self, host, port):
+        # on an already running loop, like the headless monitor's
+        self.loop = asyncio.get_running_loop()
+        for dev_id, ip, status in self.registry.snapshot():
+            self.devices[dev_id] = {"ip": ip, "status": status, "online": self.liveness.is_online(dev_id)}
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.loop.create_task(self.keepalive())
+
+    def start_in_thread(self, host, port):
+        # for the Qt client: the dashboard gets its own event loop on a daemon thread
+        started = threading.Event()
+        errors = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self.start(host, port))
+            except OSError as e:
+                errors.append(e)
+                return
+            finally:
+                started.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        if errors:
+            raise errors[0]
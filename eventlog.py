@@ -0,0 +1,291 @@
+import argparse, datetime, json, os, sys, threading, time
+from collections import deque
+
+# Append-only log of tally events for post-show analysis: status changes, online/offline, button
+# presses and prompts, one JSON line each. Written by client.py --event-log or monitor.py
+# --event-log, queried with
+#
+#     python eventlog.py show.log --device 3 --status live --from 19:00 --to 20:00
+#
+# Next to the log a .idx file gets a JSON line at most every EVENT_LOG_INDEX_INTERVAL: the time and
+# byte offset reached, the devices with events since the previous entry and every device's status at
+# that point (idle ones left out). A query only reads the blocks its device shows up in.
+
+EVENT_LOG_MAX_BYTES = 64 << 20  # rotated to .1, .2, ... once this big
+EVENT_LOG_BACKUPS = 5
+EVENT_LOG_FLUSH_INTERVAL = 0.5  # seconds events wait in memory before the writer thread writes them
+EVENT_LOG_INDEX_INTERVAL = 60.0
+EVENT_LOG_MAX_PENDING = 100000  # events held while the disk is stuck, the oldest are dropped beyond that
+STATUS_NAMES = {"idle": 0, "preview": 1, "live": 2}
+
+
+class EventLog:
+    # record() is safe from any thread and only appends to a deque. The file is written by the log's
+    # own thread, so a slow disk can't hold up the listener or the GUI.
+    def __init__(self, path, max_bytes=EVENT_LOG_MAX_BYTES, backups=EVENT_LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.pending = deque(maxlen=EVENT_LOG_MAX_PENDING)
+        self.stopping = threading.Event()
+        self.states = {}
+        self.devices = set()  # with events since the last index entry
+        self.next_index = 0.0  # the first event always opens a block
+        self.last_time = None
+        self.open()  # errors surface here, in the caller, rather than on the writer thread
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def record(self, event, device_id=None, **fields):
+        self.pending.append(dict(time=time.time(), event=event, device_id=device_id, **fields))
+
+    def record_changes(self, changed, online, offline):
+        # registry subscriber, on the listener thread
+        now = time.time()
+        for dev_id, ip, status in changed:
+            self.pending.append({"time": now, "event": "status", "device_id": dev_id, "ip": ip, "status": status})
+        for dev_id in online:
+            self.pending.append({"time": now, "event": "online", "device_id": dev_id})
+        for dev_id in offline:
+            self.pending.append({"time": now, "event": "offline", "device_id": dev_id})
+
+    def open(self):
+        entries = read_index(self.path)
+        offset = entries[-1]["offset"] if entries else 0
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if offset > size:
+            entries, offset = [], 0
+        self.states = dict(entries[-1]["states"]) if entries else {}
+        # whatever was written after the last index entry, e.g. by a run that crashed
+        for event in read_block(self.path, offset) if size else ():
+            self.track(event)
+        self.file = open(self.path, 'ab')
+        if size:
+            with open(self.path, 'rb') as f:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    self.file.write(b"\n")  # never glue a new event onto a half-written one
+        self.index = open(self.path + '.idx', 'a', encoding='utf-8')
+
+    def track(self, event):
+        self.last_time = event["time"]
+        if event.get("device_id") is not None:
+            self.devices.add(event["device_id"])
+        if event.get("event") == "status":
+            if event.get("status"):
+                self.states[event["device_id"]] = event["status"]
+            else:
+                self.states.pop(event["device_id"], None)
+
+    def write_index(self, now):
+        entry = {"time": now, "offset": self.file.tell(), "devices": sorted(self.devices), "states": self.states}
+        self.index.write(json.dumps(entry, separators=(',', ':')) + "\n")
+        self.index.flush()
+        self.devices.clear()
+        self.next_index = now + EVENT_LOG_INDEX_INTERVAL
+
+    def write_pending(self):
+        lines = []
+        while self.pending:
+            event = self.pending.popleft()
+            if event["time"] >= self.next_index:
+                # a new block starts with this event, so the entry's time is never after anything in it
+                self.file.write(b"".join(lines))
+                lines = []
+                self.write_index(event["time"])
+            self.track(event)
+            lines.append(json.dumps(event, separators=(',', ':')).encode('utf-8') + b"\n")
+        if lines:
+            self.file.write(b"".join(lines))
+            self.file.flush()
+            if self.file.tell() >= self.max_bytes:
+                self.rotate()
+
+    def end_block(self):
+        # an entry at the end of the file, so the last block's devices are known too
+        if self.devices:
+            self.write_index(self.last_time)
+
+    def rotate(self):
+        self.end_block()
+        self.file.close()
+        self.index.close()
+        for number in range(self.backups, 0, -1):
+            source = self.path if number == 1 else f"{self.path}.{number - 1}"
+            for suffix in ("", ".idx"):
+                if os.path.exists(source + suffix):
+                    os.replace(source + suffix, f"{self.path}.{number}{suffix}")
+        self.file = open(self.path, 'ab')
+        self.index = open(self.path + '.idx', 'a', encoding='utf-8')
+        self.next_index = 0.0
+
+    def run(self):
+        while not self.stopping.wait(EVENT_LOG_FLUSH_INTERVAL):
+            try:
+                self.write_pending()
+            except OSError:
+                pass  # disk full and the like; events are lost, never the tallies
+        try:
+            self.write_pending()
+            self.end_block()
+        except OSError:
+            pass
+        self.file.close()
+        self.index.close()
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+
+
+def read_index(path):
+    entries = []
+    try:
+        with open(path + '.idx', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue  # a crash can leave half a line
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def read_block(path, offset=0, end=None):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read() if end is None else f.read(end - offset)
+    for line in data.splitlines():
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(event, dict) and isinstance(event.get("time"), (int, float)):
+            yield event
+
+
+def log_files(path):
+    # the rotated copies, oldest first, then the log being written
+    files = []
+    number = 1
+    while os.path.exists(f"{path}.{number}"):
+        files.append(f"{path}.{number}")
+        number += 1
+    return files[::-1] + [path]
+
+
+def blocks(path):
+    # every block of every file in time order: its start time, the next block's start ("until"),
+    # where it is, the devices in it (None if unknown, so it has to be read) and the statuses at its start
+    result = []
+    for file in log_files(path):
+        if not os.path.exists(file):
+            continue
+        entries = read_index(file)
+        if not entries or entries[0]["offset"] > 0:
+            # written before the index was, e.g. the tail a crashed run left behind
+            entries.insert(0, {"time": 0.0, "offset": 0, "devices": [], "states": {}})
+        for entry, following in zip(entries, entries[1:] + [None]):
+            result.append({"file": file, "time": entry["time"], "offset": entry["offset"],
+                           "end": None if following is None else following["offset"],
+                           "devices": None if following is None else set(following["devices"]),
+                           "states": entry["states"]})
+    for block, following in zip(result, result[1:] + [None]):
+        block["until"] = float('inf') if following is None else following["time"]
+    return result
+
+
+def read_events(path, start=None, end=None, device_id=None):
+    start = float('-inf') if start is None else start
+    end = float('inf') if end is None else end
+    for block in blocks(path):
+        if block["until"] < start or block["time"] > end or block["offset"] == block["end"]:
+            continue
+        if device_id is not None and block["devices"] is not None and device_id not in block["devices"]:
+            continue
+        for event in read_block(block["file"], block["offset"], block["end"]):
+            if start <= event["time"] <= end and (device_id is None or event.get("device_id") == device_id):
+                yield event
+
+
+def status_intervals(path, device_id, status, start=None, end=None):
+    # [(from, to)] the device spent in status between start and end; the status at the start comes
+    # from the index, so only the blocks with the device's own events are read
+    start = 0.0 if start is None else start
+    end = time.time() if end is None else end
+    intervals = []
+    since = current = None
+    for block in blocks(path):
+        if block["until"] < start:
+            continue
+        if block["time"] > end:
+            break
+        if current is None:
+            current = block["states"].get(device_id, 0)
+            since = start if current == status else None
+        if block["devices"] is not None and device_id not in block["devices"]:
+            continue
+        for event in read_block(block["file"], block["offset"], block["end"]):
+            if event.get("device_id") != device_id or event.get("event") != "status":
+                continue
+            if event["time"] > end:
+                break
+            moment = max(event["time"], start)
+            if event["status"] == status and since is None:
+                since = moment
+            elif event["status"] != status and since is not None:
+                if moment > since:
+                    intervals.append((since, moment))
+                since = None
+    if since is not None and end > since:
+        intervals.append((since, end))
+    return intervals
+
+
+def parse_time(text):
+    # "19:00" (today), "2025-05-17T19:00" or seconds since the epoch
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        clock = datetime.time.fromisoformat(text)
+        return datetime.datetime.combine(datetime.date.today(), clock).timestamp()
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def format_time(seconds):
+    return datetime.datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query a tally event log written with --event-log")
+    parser.add_argument('log', help="the log file, its rotated copies (.1, .2, ...) are read too")
+    parser.add_argument('--device', help="only this device id, e.g. 3 or studio-b/3")
+    parser.add_argument('--status', choices=sorted(STATUS_NAMES, key=STATUS_NAMES.get),
+                        help="list the device's intervals in this status instead of the raw events")
+    parser.add_argument('--from', dest='start', help="start time, e.g. 19:00 or 2025-05-17T19:00")
+    parser.add_argument('--to', dest='end', help="end time, same formats as --from")
+    options = parser.parse_args(argv)
+    try:
+        start = parse_time(options.start) if options.start else None
+        end = parse_time(options.end) if options.end else None
+    except ValueError as e:
+        parser.error(str(e))
+    if options.status:
+        if options.device is None:
+            parser.error("--status needs a --device")
+        total = 0.0
+        for since, until in status_intervals(options.log, options.device, STATUS_NAMES[options.status], start, end):
+            total += until - since
+            print(f"{format_time(since)}  {format_time(until)}  {until - since:8.1f} s")
+        print(f"{total:.1f} s {options.status} in total")
+    else:
+        for event in read_events(options.log, start, end, options.device):
+            sys.stdout.write(json.dumps(event) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import argparse, asyncio, json, sys, time
+
+from tally import (DEVICE_PORT, DEVICE_TIMEOUT, DEVICE_GRACE, LAG_PROBE_INTERVAL, DeviceRegistry, DatagramHandler,
+                   serve_metrics, parse_timeout)
+from dashboard import Dashboard
+from eventlog import EventLog
+
+# Headless tally monitor: the same discovery, status and button handling as client.py on an asyncio
+# event loop, without Qt or a display. Every state change is written as one JSON line, to stdout or
+# to each client connected to a localhost TCP port with --listen.
+#
+#     python monitor.py
+#     python monitor.py --listen 12010 --metrics-port 9109 --dashboard 8080
+#
+# Like the GUI it binds ports 12001-12003, so the two can't run on the same machine at once.
+
+MAX_CLIENT_BUFFER = 1 << 20  # bytes queued for a --listen client before it is dropped as too slow
+
+
+class PortProtocol(asyncio.DatagramProtocol):
+    def __init__(self, monitor, port):
+        self.monitor = monitor
+        self.port = port
+
+    def datagram_received(self, data, addr):
+        self.monitor.receive(self.port, data, addr)
+
+    def error_received(self, exc):
+        # WSAECONNRESET on Windows after an ICMP port-unreachable, the endpoint is still usable
+        pass
+
+
+class Monitor(DatagramHandler):
+    def __init__(self, registry, device_port=DEVICE_PORT, host='0.0.0.0'):
+        super().__init__(registry)
+        self.device_port = device_port
+        self.host = host
+        self.transports = []
+        self.send_transport = None
+        self.timer = None
+        self.timer_at = None
+        self.probe = None
+        self.lag_expected = None
+        self.outputs = []  # callables taking a chunk of JSON lines
+        self.event_log = None
+        registry.subscribe(self.publish)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for port in self.handlers:
+            transport, _ = await loop.create_datagram_endpoint(lambda port=port: PortProtocol(self, port),
+                                                               local_addr=(self.host, port))
+            self.transports.append(transport)
+        self.send_transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                                     local_addr=('0.0.0.0', 0))
+        self.lag_expected = time.monotonic() + LAG_PROBE_INTERVAL
+        self.probe = loop.call_later(LAG_PROBE_INTERVAL, self.probe_event_loop)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.probe is not None:
+            self.probe.cancel()
+        for transport in self.transports + [self.send_transport]:
+            if transport is not None:
+                transport.close()
+
+    def receive(self, port, data, addr):
+        self.deliver(port, data, addr)
+        self.schedule()
+
+    def schedule(self):
+        # one timer for both flushes and liveness, only moved when something is due sooner
+        deadline = self.next_deadline()
+        if deadline is None or (self.timer_at is not None and self.timer_at <= deadline):
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer_at = deadline
+        self.timer = asyncio.get_running_loop().call_later(max(0.0, deadline - self.clock()), self.on_timer)
+
+    def on_timer(self):
+        self.timer = self.timer_at = None
+        self.tick(self.clock())
+        self.schedule()
+
+    def probe_event_loop(self):
+        # a late probe means the loop was busy; the packet rates are sampled here too, as the GUI does
+        now = time.monotonic()
+        self.metrics.loop_lag.observe(max(0.0, now - self.lag_expected))
+        self.metrics.sample_rates(now)
+        self.lag_expected = now + LAG_PROBE_INTERVAL
+        self.probe = asyncio.get_running_loop().call_later(LAG_PROBE_INTERVAL, self.probe_event_loop)
+
+    def send_datagram(self, payload, ip):
+        self.send_transport.sendto(payload, (ip, self.device_port))
+
+    def button_pressed_by(self, dev_id):
+        self.emit([{"event": "button", "device_id": dev_id}])
+        if self.event_log is not None:
+            self.event_log.record("button", dev_id)
+
+    def prompt_updated(self, delivery):
+        self.emit([{"event": "prompt", "id": delivery.message_id, "device_id": delivery.device_id,
+                    "state": delivery.state, "attempts": delivery.attempts, "rtt": delivery.rtt}])
+        if self.event_log is not None:
+            self.event_log.record("delivery", delivery.device_id, id=delivery.message_id, state=delivery.state,
+                                  attempts=delivery.attempts)
+
+    def publish(self, changed, online, offline):
+        events = [{"event": "status", "device_id": dev_id, "ip": ip, "status": status} for dev_id, ip, status in changed]
+        events += [{"event": "online", "device_id": dev_id} for dev_id in online]
+        events += [{"event": "offline", "device_id": dev_id} for dev_id in offline]
+        self.emit(events)
+
+    def emit(self, events):
+        now = time.time()
+        chunk = "".join(json.dumps(dict(event, time=now)) + "\n" for event in events)
+        for output in list(self.outputs):
+            output(chunk)
+
+    def state(self):
+        # what a newly connected client needs before the stream of changes makes sense
+        return [{"event": "status", "device_id": dev_id, "ip": ip, "status": status,
+                 "online": self.liveness.is_online(dev_id)} for dev_id, ip, status in self.registry.snapshot()]
+
+    async def add_client(self, reader, writer):
+        def output(chunk):
+            if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                drop()
+            else:
+                writer.write(chunk.encode('utf-8'))
+
+        def drop():
+            if output in self.outputs:
+                self.outputs.remove(output)
+            writer.close()
+
+        now = time.time()
+        writer.write("".join(json.dumps(dict(event, time=now)) + "\n" for event in self.state()).encode('utf-8'))
+        self.outputs.append(output)
+        try:
+            # clients only listen; reading just notices when they hang up
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        drop()
+
+
+def write_stdout(chunk):
+    sys.stdout.write(chunk)
+    sys.stdout.flush()
+
+
+async def run(options):
+    monitor = Monitor(DeviceRegistry(), options.device_port, options.host)
+    if options.device_grace is not None:
+        monitor.liveness.grace = options.device_grace
+    for device_id, seconds in options.device_timeout:
+        if device_id is None:
+            monitor.liveness.timeout = seconds
+        else:
+            monitor.liveness.set_timeout(device_id, seconds)
+    server = None
+    if options.listen:
+        server = await asyncio.start_server(monitor.add_client, '127.0.0.1', options.listen)
+    else:
+        monitor.outputs.append(write_stdout)
+    await monitor.start()
+    if options.event_log:
+        monitor.event_log = EventLog(options.event_log)
+        monitor.registry.subscribe(monitor.event_log.record_changes)
+    if options.dashboard:
+        dashboard = Dashboard(monitor.registry, monitor.liveness)
+        await dashboard.start(options.dashboard_host, options.dashboard)
+        monitor.registry.subscribe(dashboard.publish)
+    metrics_server = None
+    if options.metrics_port:
+        metrics_server = serve_metrics([(monitor.metrics, monitor.registry, monitor.liveness)], options.metrics_port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        monitor.close()
+        if server is not None:
+            server.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if monitor.event_log is not None:
+            monitor.event_log.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless M5 tally monitor, state changes as JSON lines")
+    parser.add_argument('--host', default='0.0.0.0', help="address to bind the discovery, status and button ports on")
+    parser.add_argument('--device-port', type=int, default=DEVICE_PORT,
+                        help="port the M5s listen on for connected pings (simulator.py uses its own)")
+    parser.add_argument('--listen', type=int,
+                        help="stream JSON lines to clients of this localhost TCP port instead of stdout")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve /metrics (Prometheus text) and /metrics.json on this localhost port")
+    parser.add_argument('--dashboard', type=int, metavar='PORT', help="serve a read-only tally page for browsers on this port")
+    parser.add_argument('--dashboard-host', default='127.0.0.1',
+                        help="address for --dashboard, 0.0.0.0 to let phones on the LAN connect")
+    parser.add_argument('--event-log', help="append every tally change and button press to this file, "
+                                            "query it with eventlog.py")
+    parser.add_argument('--device-timeout', action='append', default=[], metavar='[DEVICE=]SECONDS',
+                        help="silence before a device is reported offline, for all devices or one, e.g. "
+                             f"--device-timeout 5 --device-timeout 3=10 (default {DEVICE_TIMEOUT:g})")
+    parser.add_argument('--device-grace', type=float, metavar='SECONDS',
+                        help=f"slack added to every timeout so one late beacon doesn't flap a tally "
+                             f"(default {DEVICE_GRACE:g})")
+    options = parser.parse_args(argv)
+    try:
+        options.device_timeout = [parse_timeout(spec) for spec in options.device_timeout]
+    except ValueError as e:
+        parser.error(str(e))
+    if options.device_grace is not None and options.device_grace < 0:
+        parser.error("--device-grace can't be negative")
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    try:
+        asyncio.run(run(options))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
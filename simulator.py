@@ -0,0 +1,241 @@
+import argparse, heapq, ipaddress, json, random, selectors, socket, time
+
+from tally import DISCOVERY_PORT, STATUS_PORT, BUTTON_PORT, build_status
+
+# Acts as a fleet of M5 tallies on one machine. Every virtual device gets its own loopback address
+# (127.0.0.10, 127.0.0.11, ... on Linux), because the client tells devices apart by IP and answers
+# them on that IP. The client already owns port 12002 on this host, so start it with the same
+# device port the simulator listens on:
+#
+#     python client.py --device-port 12012
+#     python simulator.py --count 50 --device-port 12012
+
+SIM_DEVICE_PORT = 12012
+
+
+class VirtualM5:
+    def __init__(self, device_id, ip, device_port, client_host, binary=False, ack=True, prompt_loss=0.0,
+                 client_ports=(DISCOVERY_PORT, STATUS_PORT, BUTTON_PORT)):
+        self.device_id = device_id
+        self.ip = ip
+        self.client_host = client_host
+        self.discovery_port, self.status_port, self.button_port = client_ports
+        self.binary = binary
+        self.ack = ack
+        self.prompt_loss = prompt_loss
+        self.prompt_ids = set()
+        self.repeats = 0
+        self.status = 0
+        self.sequence = 0
+        self.battery = random.randint(20, 100)
+        self.connected = False
+        self.acks = 0
+        self.relayed = 0
+        self.prompts = []
+        self.sent = {"discovery": 0, "status": 0, "button": 0}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((ip, device_port))
+        self.sock.setblocking(False)
+
+    def send_discovery(self):
+        self.sock.sendto(bytes([self.device_id]), (self.client_host, self.discovery_port))
+        self.sent["discovery"] += 1
+
+    def status_payload(self):
+        if self.binary:
+            self.sequence = (self.sequence + 1) & 0xFFFF
+            return build_status(self.device_id, self.status, self.sequence, self.battery, random.randint(-80, -40))
+        return json.dumps({"device_id": self.device_id, "status": self.status}).encode('utf-8')
+
+    def send_status(self, copies=1):
+        # repeated copies carry the same sequence number, like firmware resending a state it isn't sure arrived
+        payload = self.status_payload()
+        for _ in range(copies):
+            self.sock.sendto(payload, (self.client_host, self.status_port))
+            self.sent["status"] += 1
+
+    def press_button(self):
+        self.sock.sendto(bytes([self.device_id]), (self.client_host, self.button_port))
+        self.sent["button"] += 1
+
+    def receive(self, quiet=False):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(1024)
+            except BlockingIOError:
+                return
+            except OSError:
+                continue
+            try:
+                message = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+            if not isinstance(message, dict):
+                continue
+            if message.get("connected"):
+                self.connected = True
+                self.acks += 1
+            if "tally" in message:
+                # relay mode, the client passes on the mixer's tally; the new state is reported at once
+                self.relayed += 1
+                if message["tally"] != self.status:
+                    self.status = message["tally"]
+                    self.send_status()
+            elif "message" in message:
+                if random.random() < self.prompt_loss:
+                    continue
+                message_id = message.get("id")
+                if self.ack and message_id is not None:
+                    ack = json.dumps({"ack": message_id, "device_id": self.device_id}).encode('utf-8')
+                    self.sock.sendto(ack, (self.client_host, self.status_port))
+                    if message_id in self.prompt_ids:
+                        # a retransmission whose ack got lost, answered again but not shown twice
+                        self.repeats += 1
+                        continue
+                    self.prompt_ids.add(message_id)
+                self.prompts.append(message["message"])
+                if not quiet:
+                    print(f"M5 {self.device_id} got prompt: {message['message']}")
+
+    def close(self):
+        self.sock.close()
+
+
+class Fleet:
+    def __init__(self, options):
+        self.options = options
+        base = ipaddress.IPv4Address(options.base_ip)
+        self.devices = [VirtualM5(options.first_id + i, str(base + i), options.device_port, options.host,
+                                  options.binary, not options.no_ack, options.prompt_loss, options.client_ports)
+                        for i in range(options.count)]
+        self.selector = selectors.DefaultSelector()
+        for device in self.devices:
+            self.selector.register(device.sock, selectors.EVENT_READ, device)
+        self.timers = []
+        self.timer_seq = 0
+        self.cuts = 0
+
+    def schedule(self, delay, action, *args):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (time.monotonic() + delay, self.timer_seq, action, args))
+
+    def every(self, rate):
+        # +-10% jitter so a fleet started together doesn't stay in lockstep
+        return random.uniform(0.9, 1.1) / rate
+
+    def beacon(self, device):
+        device.send_discovery()
+        self.schedule(self.every(self.options.beacon_rate), self.beacon, device)
+
+    def heartbeat(self, device):
+        device.send_status()
+        self.schedule(self.every(self.options.status_rate), self.heartbeat, device)
+
+    def cut(self):
+        # the mixer takes a new camera to program and another to preview, changed tallies report at once
+        live, preview = random.sample(self.devices, 2) if len(self.devices) > 1 else (self.devices[0], None)
+        for device in self.devices:
+            status = 2 if device is live else 1 if device is preview else 0
+            if device.status != status:
+                device.status = status
+                device.send_status(self.options.burst)
+        self.cuts += 1
+        self.schedule(random.expovariate(self.options.cut_rate), self.cut)
+
+    def button(self):
+        random.choice(self.devices).press_button()
+        self.schedule(random.expovariate(self.options.button_rate), self.button)
+
+    def start(self):
+        for device in self.devices:
+            # spread the boot over one beacon period, or all at once with --boot-storm
+            delay = 0 if self.options.boot_storm else random.uniform(0, 1 / self.options.beacon_rate)
+            self.schedule(delay, self.beacon, device)
+            if self.options.status_rate > 0:
+                self.schedule(delay + self.every(self.options.status_rate), self.heartbeat, device)
+        if self.options.cut_rate > 0 and self.devices:
+            self.schedule(random.expovariate(self.options.cut_rate), self.cut)
+        if self.options.button_rate > 0 and self.devices:
+            self.schedule(random.expovariate(self.options.button_rate), self.button)
+
+    def run(self):
+        self.start()
+        end = time.monotonic() + self.options.duration if self.options.duration else None
+        while end is None or time.monotonic() < end:
+            due = self.timers[0][0] if self.timers else time.monotonic() + 1
+            if end is not None:
+                due = min(due, end)
+            for key, _ in self.selector.select(max(0.0, due - time.monotonic())):
+                key.data.receive(self.options.quiet)
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, action, args = heapq.heappop(self.timers)
+                action(*args)
+
+    def report(self):
+        sent = {kind: sum(device.sent[kind] for device in self.devices) for kind in ("discovery", "status", "button")}
+        connected = sum(device.connected for device in self.devices)
+        print(f"{len(self.devices)} devices, {connected} connected, {self.cuts} cuts")
+        print(f"sent: {sent['discovery']} discovery, {sent['status']} status, {sent['button']} button")
+        print(f"received: {sum(device.acks for device in self.devices)} connected pings, "
+              f"{sum(len(device.prompts) for device in self.devices)} prompts, "
+              f"{sum(device.repeats for device in self.devices)} repeated prompts, "
+              f"{sum(device.relayed for device in self.devices)} relayed tallies")
+
+    def close(self):
+        self.selector.close()
+        for device in self.devices:
+            device.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a fleet of M5 tally devices against client.py")
+    parser.add_argument('--count', type=int, default=20, help="number of virtual devices")
+    parser.add_argument('--first-id', type=int, default=1, help="device id of the first virtual device")
+    parser.add_argument('--host', default='127.0.0.1', help="address the client listens on")
+    parser.add_argument('--client-ports', default=f"{DISCOVERY_PORT},{STATUS_PORT},{BUTTON_PORT}",
+                        metavar='DISCOVERY,STATUS,BUTTON', help="the client's ports, for a client.py --network")
+    parser.add_argument('--base-ip', default='127.0.0.10', help="loopback address of the first virtual device")
+    parser.add_argument('--device-port', type=int, default=SIM_DEVICE_PORT,
+                        help="port the virtual devices listen on, pass the same to client.py --device-port")
+    parser.add_argument('--binary', action='store_true', help="send binary status frames instead of JSON")
+    parser.add_argument('--beacon-rate', type=float, default=1.0, help="discovery beacons per second per device")
+    parser.add_argument('--status-rate', type=float, default=1.0,
+                        help="unchanged status resends per second per device, 0 to only send on change")
+    parser.add_argument('--cut-rate', type=float, default=0.5, help="mixer cuts per second across the fleet")
+    parser.add_argument('--burst', type=int, default=1, help="copies of each status packet sent on a cut")
+    parser.add_argument('--button-rate', type=float, default=0.1, help="button presses per second across the fleet")
+    parser.add_argument('--boot-storm', action='store_true', help="boot every device in the same instant")
+    parser.add_argument('--duration', type=float, default=0, help="seconds to run, 0 runs until Ctrl+C")
+    parser.add_argument('--quiet', action='store_true', help="don't print received prompts")
+    parser.add_argument('--no-ack', action='store_true', help="behave like old firmware that doesn't ack prompts")
+    parser.add_argument('--prompt-loss', type=float, default=0.0,
+                        help="fraction of incoming prompts to drop, to exercise retransmission")
+    options = parser.parse_args(argv)
+    try:
+        options.client_ports = tuple(int(port) for port in options.client_ports.split(","))
+    except ValueError:
+        options.client_ports = ()
+    if len(options.client_ports) != 3:
+        parser.error("--client-ports takes three ports: discovery, status and button")
+    if options.beacon_rate <= 0:
+        parser.error("--beacon-rate must be positive, real M5s always beacon")
+    if options.first_id < 0 or options.first_id + options.count > 256:
+        parser.error("device ids are sent as a single byte, they must stay within 0-255")
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    fleet = Fleet(options)
+    try:
+        fleet.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fleet.report()
+        fleet.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,960 @@
+import socket, heapq, bisect, struct, json, time, os
+
+# The M5 protocol, device registry and liveness tracking without any Qt, shared by client.py and
+# the headless monitor.py.
+
+DISCOVERY_PORT = 12001
+STATUS_PORT = 12002
+BUTTON_PORT = 12003
+DEVICE_PORT = 12002  # where the M5s listen for connected pings and prompts
+CONNECTED_PING = json.dumps({"connected": True}).encode('utf-8')
+
+STATUS_FLUSH_INTERVAL = 0.016  # one GUI update per ~60 Hz frame at most
+MAX_DRAIN = 256  # datagrams read per socket per wakeup, so one flooded port can't starve the others
+DEVICE_TIMEOUT = 2.0  # seconds without any packet before a device is shown as offline
+DEVICE_GRACE = 0.5  # extra slack on top of every timeout so one late beacon doesn't flap the tally
+ACK_INTERVAL = 1.0  # minimum seconds between connected pings to a device that is already known and online
+SEQUENCE_WINDOW = 1.0  # older sequence numbers are only rejected this soon after the last status, so reboots still get through
+RATE_INTERVAL = 1.0  # window for the packets per second figures
+LAG_PROBE_INTERVAL = 0.25  # how often the GUI's and the monitor's event loops are checked for late timers
+CAPTURE_INDEX_INTERVAL = 1.0  # seconds of traffic between index entries in a capture
+PROMPT_RTO = 0.3  # retransmission timeout for a device without RTT samples yet
+MIN_PROMPT_RTO = 0.05
+MAX_PROMPT_RTO = 3.0
+PROMPT_RETRIES = 5  # retransmissions before a prompt is given up on
+SNAPSHOT_MAX_AGE = 24 * 3600  # devices not seen for this long aren't brought back at startup
+
+
+# Binary status frame, version 1: magic, version, device id, status, 16-bit sequence number,
+# optionally followed by battery percent (255 = unknown) and RSSI in dBm. Anything that does not
+# start with the magic is parsed as the JSON status older firmware sends.
+STATUS_MAGIC = b'M5'
+STATUS_VERSION = 1
+STATUS_FRAME = struct.Struct('!2sBBBH')
+STATUS_TELEMETRY = struct.Struct('!Bb')
+NO_BATTERY = 255
+STATUSES = (0, 1, 2)  # idle, preview, live
+
+
+def parse_timeout(spec):
+    # "5" for every device, "3=10" or "studio-b/3=10" for one -> (device id or None, seconds)
+    device_id, _, seconds = spec.rpartition('=')
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        seconds = 0.0
+    if not seconds > 0:
+        raise ValueError(f"bad timeout {spec}, expected [DEVICE=]SECONDS above 0")
+    return device_id or None, seconds
+
+
+def device_key(device_id):
+    # "3" or "studio-b/3"; sorts by network first, then numerically
+    network, _, number = device_id.rpartition('/')
+    return network, int(number)
+
+
+def parse_status(data):
+    if data[:2] == STATUS_MAGIC:
+        if len(data) != STATUS_FRAME.size and len(data) != STATUS_FRAME.size + STATUS_TELEMETRY.size:
+            raise ValueError(f"bad status frame length {len(data)}")
+        _, version, device_id, status, sequence = STATUS_FRAME.unpack_from(data)
+        if version != STATUS_VERSION:
+            raise ValueError(f"unsupported status frame version {version}")
+        battery = rssi = None
+        if len(data) > STATUS_FRAME.size:
+            battery, rssi = STATUS_TELEMETRY.unpack_from(data, STATUS_FRAME.size)
+            if battery == NO_BATTERY:
+                battery = None
+        if status not in STATUSES:
+            raise ValueError(f"bad status {status}")
+        return str(device_id), status, sequence, battery, rssi
+    message = json.loads(data.decode('utf-8'))
+    device_id, status = message['device_id'], message['status']
+    # bool is an int too, and neither true nor 1.0 is a device id the wall can sort or a status it can draw
+    if type(device_id) is not int or not 0 <= device_id <= 255:
+        raise ValueError(f"bad device id {device_id!r}")
+    if type(status) is not int or status not in STATUSES:
+        raise ValueError(f"bad status {status!r}")
+    return str(device_id), status, None, None, None
+
+
+def build_status(device_id, status, sequence, battery=None, rssi=None):
+    frame = STATUS_FRAME.pack(STATUS_MAGIC, STATUS_VERSION, int(device_id), status, sequence & 0xFFFF)
+    if battery is None and rssi is None:
+        return frame
+    return frame + STATUS_TELEMETRY.pack(NO_BATTERY if battery is None else battery, rssi or 0)
+
+
+class DeviceRecord:
+    __slots__ = ('device_id', 'ip_address', 'status', 'last_seen', 'last_ack', 'last_status',
+                 'sequence', 'battery', 'rssi', 'discovery_packets', 'status_packets', 'button_packets',
+                 'last_beacon', 'beacon_interval', 'jitter', 'srtt', 'rttvar', 'rto', 'acks_prompts',
+                 'status_restored')
+
+    def __init__(self, device_id, ip_address):
+        self.device_id = device_id
+        self.ip_address = ip_address
+        self.status = 0
+        self.last_seen = 0.0
+        self.last_ack = 0.0
+        self.last_status = 0.0
+        self.sequence = None
+        self.battery = None
+        self.rssi = None
+        self.discovery_packets = 0
+        self.status_packets = 0
+        self.button_packets = 0
+        self.last_beacon = 0.0
+        self.beacon_interval = None
+        self.jitter = 0.0
+        self.srtt = None
+        self.rttvar = None
+        self.rto = PROMPT_RTO
+        self.acks_prompts = False
+        self.status_restored = False  # status comes from the last run's snapshot, not from the device
+
+    def snapshot(self):
+        return self.device_id, self.ip_address, self.status
+
+    def sample_rtt(self, rtt):
+        # RFC 6298 smoothing
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_PROMPT_RTO), MAX_PROMPT_RTO)
+
+
+class DeviceRegistry:
+    # Single writer: only the UdpListener thread calls the record_* methods and notify(), so no lock
+    # is taken. Other threads only read, and single dict lookups and attribute reads are atomic.
+    def __init__(self):
+        self.devices = {}
+        self.ips = {}
+        self.subscribers = []
+
+    def __contains__(self, device_id):
+        return device_id in self.devices
+
+    def __len__(self):
+        return len(self.devices)
+
+    def get(self, device_id):
+        return self.devices.get(device_id)
+
+    def find_by_ip(self, ip):
+        device_id = self.ips.get(ip)
+        return None if device_id is None else self.devices.get(device_id)
+
+    def snapshot(self):
+        return [record.snapshot() for record in list(self.devices.values())]
+
+    def subscribe(self, callback):
+        # callback(changed, online, offline) runs on the listener thread; Qt receivers should pass
+        # a signal's emit so delivery is queued onto their own thread.
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def notify(self, changed, online, offline):
+        for callback in list(self.subscribers):
+            callback(changed, online, offline)
+
+    def touch(self, device_id, ip, now):
+        record = self.devices.get(device_id)
+        changed = record is None
+        if changed:
+            record = DeviceRecord(device_id, ip)
+            self.devices[device_id] = record
+            self.ips[ip] = device_id
+        elif record.ip_address != ip:
+            if self.ips.get(record.ip_address) == device_id:
+                del self.ips[record.ip_address]
+            record.ip_address = ip
+            self.ips[ip] = device_id
+            changed = True
+        record.last_seen = now
+        return record, changed
+
+    def record_discovery(self, device_id, ip, now):
+        record, changed = self.touch(device_id, ip, now)
+        record.discovery_packets += 1
+        if record.last_beacon:
+            interval = now - record.last_beacon
+            if record.beacon_interval is not None:
+                # smoothed like RTP interarrival jitter (RFC 3550), beacons should come at a steady rate
+                record.jitter += (abs(interval - record.beacon_interval) - record.jitter) / 16
+            record.beacon_interval = interval
+        record.last_beacon = now
+        return changed
+
+    def is_stale(self, device_id, sequence, now):
+        record = self.devices.get(device_id)
+        if record is None or record.sequence is None or sequence is None:
+            return False
+        if now - record.last_status > SEQUENCE_WINDOW:
+            return False
+        # serial number arithmetic, so the 16-bit counter can wrap
+        return not 0 < (sequence - record.sequence) & 0xFFFF < 0x8000
+
+    def record_status(self, device_id, ip, status, now, sequence=None, battery=None, rssi=None):
+        record, changed = self.touch(device_id, ip, now)
+        record.status_packets += 1
+        record.last_status = now
+        record.sequence = sequence
+        record.status_restored = False
+        if battery is not None:
+            record.battery = battery
+        if rssi is not None:
+            record.rssi = rssi
+        if record.status != status:
+            record.status = status
+            changed = True
+        return changed
+
+    def restore(self, device_id, ip, status, last_seen):
+        # a device remembered from the last run, known but not online until it checks in again
+        record, _ = self.touch(device_id, ip, last_seen)
+        record.status = status
+        record.status_restored = True
+        return record
+
+    def check_in(self, device_id):
+        # a restored device is back; last run's status isn't this run's, so it shows idle until it
+        # reports one, never a stale live -> whether the status changed
+        record = self.devices.get(device_id)
+        if record is None or not record.status_restored:
+            return False
+        record.status_restored = False
+        changed = record.status != 0
+        record.status = 0
+        return changed
+
+    def record_button(self, device_id, now):
+        record = self.devices.get(device_id)
+        if record is not None:
+            record.last_seen = now
+            record.button_packets += 1
+
+
+class LivenessTracker:
+    # One heap entry per online device. Seeing a device again only moves its deadline in the dict;
+    # a popped entry that is no longer current is pushed back with the real deadline.
+    def __init__(self, timeout=DEVICE_TIMEOUT, grace=DEVICE_GRACE):
+        self.timeout = timeout
+        self.grace = grace
+        self.timeouts = {}
+        self.deadlines = {}
+        self.heap = []
+
+    def set_timeout(self, device_id, timeout):
+        if timeout is None:
+            self.timeouts.pop(device_id, None)
+        else:
+            self.timeouts[device_id] = timeout
+        deadline = self.deadlines.get(device_id)
+        if deadline is not None:
+            # a shorter timeout has to be able to fire before the entry already in the heap; a longer
+            # one takes over the next time the device is seen
+            earlier = time.monotonic() + self.timeout_for(device_id)
+            if earlier < deadline:
+                self.deadlines[device_id] = earlier
+                heapq.heappush(self.heap, (earlier, device_id))
+
+    def timeout_for(self, device_id):
+        return self.timeouts.get(device_id, self.timeout) + self.grace
+
+    def is_online(self, device_id):
+        return device_id in self.deadlines
+
+    def seen(self, device_id, now):
+        deadline = now + self.timeout_for(device_id)
+        came_online = device_id not in self.deadlines
+        self.deadlines[device_id] = deadline
+        if came_online:
+            heapq.heappush(self.heap, (deadline, device_id))
+        return came_online
+
+    def next_deadline(self):
+        return self.heap[0][0] if self.heap else None
+
+    def expire(self, now):
+        offline = []
+        while self.heap and self.heap[0][0] <= now:
+            _, device_id = heapq.heappop(self.heap)
+            deadline = self.deadlines.get(device_id)
+            if deadline is None:
+                continue
+            if deadline > now:
+                heapq.heappush(self.heap, (deadline, device_id))
+                continue
+            del self.deadlines[device_id]
+            offline.append(device_id)
+        return offline
+
+    def forget(self, device_id):
+        self.deadlines.pop(device_id, None)
+
+    def reset(self):
+        self.deadlines.clear()
+        self.heap.clear()
+
+
+class Histogram:
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)  # seconds
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is everything above the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, fraction):
+        # upper bound of the bucket the quantile falls in, good enough to tell 2 ms from 200 ms
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        counts = list(self.counts)
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.bounds + ("+Inf",), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {"count": cumulative, "sum": self.sum, "max": self.max, "buckets": buckets}
+
+
+class Metrics:
+    # Counters behind the diagnostics panel and exporters, one set per network. Every field has a
+    # single writer: the listener thread counts packets and queued batches, the GUI thread handled
+    # batches and loop lag.
+    def __init__(self, ports=(DISCOVERY_PORT, STATUS_PORT, BUTTON_PORT), network=''):
+        self.ports = dict(zip(ports, ("discovery", "status", "button")))
+        self.network = network
+        self.started = time.monotonic()
+        self.clock = time.monotonic  # the listener's clock, which is virtual during a replay
+        self.packets = dict.fromkeys(self.ports, 0)
+        self.malformed = dict.fromkeys(self.ports, 0)
+        self.stale_packets = 0
+        self.batches_sent = 0
+        self.batches_handled = 0
+        self.loop_lag = Histogram()
+        self.rates = dict.fromkeys(self.ports, 0.0)
+        self.rate_counts = dict(self.packets)
+        self.rate_at = self.started
+
+    def queue_depth(self):
+        # devices_changed emissions still waiting in the GUI thread's event queue
+        return self.batches_sent - self.batches_handled
+
+    def sample_rates(self, now):
+        elapsed = now - self.rate_at
+        if elapsed < RATE_INTERVAL:
+            return
+        counts = dict(self.packets)
+        self.rates = {port: (counts[port] - self.rate_counts[port]) / elapsed for port in counts}
+        self.rate_counts = counts
+        self.rate_at = now
+
+    def snapshot(self, registry, liveness=None):
+        now = self.clock()
+        devices = []
+        for record in sorted(list(registry.devices.values()), key=lambda record: device_key(record.device_id)):
+            devices.append({
+                "device_id": record.device_id,
+                "ip": record.ip_address,
+                "status": record.status,
+                "online": liveness.is_online(record.device_id) if liveness is not None else None,
+                "last_seen": now - record.last_seen,
+                "beacon_interval": record.beacon_interval,
+                "jitter": record.jitter,
+                "battery": record.battery,
+                "rssi": record.rssi,
+                "rtt": record.srtt,
+                "packets": {"discovery": record.discovery_packets, "status": record.status_packets,
+                            "button": record.button_packets},
+            })
+        return {
+            "time": time.time(),
+            "network": self.network,
+            "uptime": now - self.started,
+            "packets": {self.ports[port]: count for port, count in self.packets.items()},
+            "packets_per_second": {self.ports[port]: rate for port, rate in self.rates.items()},
+            "malformed": {self.ports[port]: count for port, count in self.malformed.items()},
+            "stale_packets": self.stale_packets,
+            "signal_queue_depth": self.queue_depth(),
+            "event_loop_lag": self.loop_lag.snapshot(),
+            "devices": devices,
+        }
+
+    def samples(self, registry, liveness=None):
+        # (family, type, sample suffix, labels, value) for prometheus_text
+        snapshot = self.snapshot(registry, liveness)
+        base = (("network", self.network),) if self.network else ()
+        for name, kind, suffix in (("packets", "counter", "_total"), ("packets_per_second", "gauge", ""),
+                                   ("malformed", "counter", "_total")):
+            for port_kind, value in snapshot[name].items():
+                yield name + suffix, kind, "", base + (("port", port_kind),), value
+        yield "stale_packets_total", "counter", "", base, snapshot["stale_packets"]
+        yield "signal_queue_depth", "gauge", "", base, snapshot["signal_queue_depth"]
+        lag = snapshot["event_loop_lag"]
+        for bound, count in lag["buckets"]:
+            yield "event_loop_lag_seconds", "histogram", "_bucket", base + (("le", bound),), count
+        yield "event_loop_lag_seconds", "histogram", "_sum", base, lag["sum"]
+        yield "event_loop_lag_seconds", "histogram", "_count", base, lag["count"]
+        for device in snapshot["devices"]:
+            labels = base + (("device", device["device_id"]),)
+            yield "device_last_seen_seconds", "gauge", "", labels, device["last_seen"]
+            yield "device_jitter_seconds", "gauge", "", labels, device["jitter"]
+            for kind, count in device["packets"].items():
+                yield "device_packets_total", "counter", "", labels + (("kind", kind),), count
+
+
+def prometheus_text(sources):
+    # sources: (metrics, registry, liveness) per network, merged so every family has one TYPE line
+    families = {}
+    for metrics, registry, liveness in sources:
+        for name, kind, suffix, labels, value in metrics.samples(registry, liveness):
+            families.setdefault((name, kind), []).append((suffix, labels, value))
+    lines = []
+    for (name, kind), samples in families.items():
+        lines.append(f"# TYPE m5_{name} {kind}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"m5_{name}{suffix}{{{label_text}}} {value}" if labels else f"m5_{name}{suffix} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(sources, port, host='127.0.0.1'):
+    # read-only scrape endpoint: /metrics in the Prometheus text format, /metrics.json as a JSON list
+    # with one snapshot per network
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    import threading
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = prometheus_text(sources).encode('utf-8')
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = json.dumps([metrics.snapshot(registry, liveness)
+                                   for metrics, registry, liveness in sources]).encode('utf-8')
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, args=(0.1,), daemon=True).start()
+    return server
+
+
+def save_snapshot(path, devices):
+    # devices: (device id, ip, status, last seen as time.time()); replaced in one step so a crash
+    # mid-write leaves the previous snapshot
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump({"version": 1, "devices": devices}, f, separators=(',', ':'))
+    os.replace(temp, path)
+
+
+def load_snapshot(path, max_age=SNAPSHOT_MAX_AGE):
+    try:
+        with open(path, encoding='utf-8') as f:
+            snapshot = json.load(f)
+        entries = snapshot["devices"] if snapshot.get("version") == 1 else []
+    except (OSError, ValueError, AttributeError, KeyError):
+        return []
+    now = time.time()
+    devices = []
+    for entry in entries:
+        try:
+            device_id, ip, status, last_seen = entry
+            device_key(device_id)
+            socket.inet_aton(ip)
+        except (ValueError, TypeError, AttributeError, OSError):
+            continue
+        if status in (0, 1, 2) and isinstance(last_seen, (int, float)) and now - last_seen <= max_age:
+            devices.append((device_id, ip, status, last_seen))
+    return devices
+
+
+# Capture files start with CAPTURE_MAGIC followed by one CAPTURE_RECORD header plus payload per
+# received datagram. Timestamps are the listener's monotonic clock, only differences between them
+# mean anything. The .idx file next to it holds a CAPTURE_INDEX entry every CAPTURE_INDEX_INTERVAL.
+CAPTURE_MAGIC = b'M5CAP\x01'
+CAPTURE_RECORD = struct.Struct('!dH4sHH')  # timestamp, port, source ip, source port, payload length
+CAPTURE_INDEX = struct.Struct('!dQ')  # timestamp, file offset of the first record at or after it
+
+
+class CaptureWriter:
+    # Owned by the listener thread. Writes are buffered, but no record waits longer than
+    # CAPTURE_INDEX_INTERVAL before it is flushed, so a crash loses at most that much traffic and
+    # read_capture stops cleanly at a truncated record.
+    def __init__(self, path):
+        self.file = open(path, 'xb')
+        self.file.write(CAPTURE_MAGIC)
+        self.file.flush()  # a run that crashes straight away still leaves a capture file
+        self.index = open(path + '.idx', 'wb')
+        self.next_index = None
+        self.flush_at = None  # when the records written since the last flush are due on disk
+        self.records = 0
+
+    def write(self, timestamp, port, addr, data):
+        if self.next_index is None or timestamp >= self.next_index:
+            self.flush()  # the records an index entry points past are on disk before the entry is
+            self.index.write(CAPTURE_INDEX.pack(timestamp, self.file.tell()))
+            self.index.flush()
+            self.next_index = timestamp + CAPTURE_INDEX_INTERVAL
+        self.file.write(CAPTURE_RECORD.pack(timestamp, port, socket.inet_aton(addr[0]), addr[1], len(data)) + data)
+        if self.flush_at is None:
+            self.flush_at = timestamp + CAPTURE_INDEX_INTERVAL
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+        self.flush_at = None
+
+    def tick(self, now):
+        # for when the traffic stops, with nothing left to write that would trigger the next index entry
+        if self.flush_at is not None and now >= self.flush_at:
+            self.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+def read_capture_index(path):
+    try:
+        with open(path + '.idx', 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    # a crash can leave half an entry at the end
+    return list(CAPTURE_INDEX.iter_unpack(data[:len(data) - len(data) % CAPTURE_INDEX.size]))
+
+
+def read_capture(path, start=0.0):
+    # yields (timestamp, port, addr, payload); start skips that many seconds into the capture,
+    # seeking through the index when there is one
+    index = read_capture_index(path)
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        if start and index:
+            position = bisect.bisect_right([entry[0] for entry in index], index[0][0] + start) - 1
+            f.seek(index[max(position, 0)][1])
+        first = None
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            timestamp, port, ip, src_port, length = CAPTURE_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            if first is None:
+                first = index[0][0] if index else timestamp
+            if timestamp - first >= start:
+                yield timestamp, port, (socket.inet_ntoa(ip), src_port), data
+
+
+class CaptureReplay:
+    # Stands in for the listener's sockets. Time is virtual, starting at the first replayed record,
+    # so liveness timeouts and flushes happen exactly where they did in the show. speed 1 is real
+    # time, 0 goes as fast as the listener can; once the capture runs out time passes normally.
+    def __init__(self, path, speed=1.0, start=0.0):
+        self.packets = read_capture(path, start)
+        self.next = next(self.packets, None)
+        self.speed = speed
+        self.virtual = self.next[0] if self.next is not None else time.monotonic()
+        self.real = time.monotonic()
+        self.replayed = 0
+
+    def now(self):
+        if self.speed:
+            return self.virtual + (time.monotonic() - self.real) * self.speed
+        return self.virtual
+
+    def due(self):
+        return None if self.next is None else self.next[0]
+
+    def delay(self, deadline):
+        if deadline is None:
+            return None
+        if self.speed:
+            return max(0.0, (deadline - self.now()) / self.speed)
+        return 0.0
+
+    def pump(self, deliver, limit):
+        # deliver what is due; at max speed stop at limit so expiry and flushes in between still happen
+        for _ in range(MAX_DRAIN):
+            if self.next is None:
+                break
+            timestamp, port, addr, data = self.next
+            if self.speed:
+                if timestamp > self.now():
+                    break
+            elif limit is not None and timestamp > limit:
+                self.virtual = max(self.virtual, limit)
+                break
+            else:
+                self.virtual = max(self.virtual, timestamp)
+            deliver(port, data, addr)
+            self.replayed += 1
+            self.next = next(self.packets, None)
+        if self.next is None and not self.speed:
+            self.speed = 1.0
+            self.real = time.monotonic()
+
+
+# Prompts carry an id, {"message": text, "id": 7}, and firmware that supports it answers on the
+# status port with {"ack": 7, "device_id": 3}.
+def build_prompt(message_id, text):
+    return json.dumps({"message": text, "id": message_id}).encode('utf-8')
+
+
+def build_relay(status, connected=False):
+    # relay mode: the tally an M5 should show, from the client's mixer connection instead of its own
+    message = {"connected": True, "tally": status} if connected else {"tally": status}
+    return json.dumps(message).encode('utf-8')
+
+
+def parse_ack(data):
+    message = json.loads(data.decode('utf-8'))
+    device_id = message.get('device_id')
+    return int(message['ack']), None if device_id is None else str(device_id)
+
+
+class PromptDelivery:
+    __slots__ = ('message_id', 'device_id', 'ip', 'payload', 'state', 'attempts', 'sent_at', 'deadline', 'rtt')
+
+    def __init__(self, message_id, device_id, ip, payload):
+        self.message_id = message_id
+        self.device_id = device_id
+        self.ip = ip
+        self.payload = payload
+        self.state = 'sending'  # then 'retrying', and finally 'delivered', 'failed' or 'unconfirmed'
+        self.attempts = 0
+        self.sent_at = 0.0
+        self.deadline = 0.0
+        self.rtt = None
+
+
+class PromptTracker:
+    # Delivery state of every prompt per device, on the registry's writer thread. Devices that never
+    # acked anything get a prompt once, their firmware may not drop repeats by id; the rest are
+    # retransmitted with exponential backoff until they ack or PROMPT_RETRIES runs out. Devices
+    # declared in acking (client.py --prompt-acks) are retransmitted to before their first ack too.
+    def __init__(self, registry):
+        self.registry = registry
+        self.acking = set()  # device ids known to run firmware that acks prompts
+        self.pending = {}  # (message_id, device_id) -> PromptDelivery
+        self.heap = []
+
+    def start(self, message_id, payload, device_ids, now):
+        deliveries = []
+        for device_id in device_ids:
+            record = self.registry.get(device_id)
+            if record is None:
+                continue
+            delivery = PromptDelivery(message_id, device_id, record.ip_address, payload)
+            self.schedule(delivery, record, now)
+            self.pending[(message_id, device_id)] = delivery
+            deliveries.append(delivery)
+        return deliveries
+
+    def schedule(self, delivery, record, now):
+        delivery.attempts += 1
+        delivery.sent_at = now
+        delivery.deadline = now + min(record.rto * 2 ** (delivery.attempts - 1), MAX_PROMPT_RTO)
+        heapq.heappush(self.heap, (delivery.deadline, delivery.message_id, delivery.device_id))
+
+    def acked(self, message_id, record, now):
+        record.acks_prompts = True
+        delivery = self.pending.pop((message_id, record.device_id), None)
+        if delivery is None:
+            return None
+        delivery.rtt = now - delivery.sent_at
+        if delivery.attempts == 1:
+            # Karn: an ack for a retransmitted prompt can't tell which copy it answers
+            record.sample_rtt(delivery.rtt)
+        delivery.state = 'delivered'
+        return delivery
+
+    def next_deadline(self):
+        while self.heap and (self.heap[0][1], self.heap[0][2]) not in self.pending:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def expire(self, now):
+        # deliveries whose state changed: retransmit the 'retrying' ones, the rest are final
+        updated = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, message_id, device_id = heapq.heappop(self.heap)
+            delivery = self.pending.get((message_id, device_id))
+            if delivery is None or delivery.deadline != deadline:
+                continue
+            record = self.registry.get(device_id)
+            if not record.acks_prompts and device_id not in self.acking:
+                delivery.state = 'unconfirmed'
+            elif delivery.attempts > PROMPT_RETRIES:
+                delivery.state = 'failed'
+            else:
+                delivery.state = 'retrying'
+                delivery.ip = record.ip_address
+                self.schedule(delivery, record, now)
+            if delivery.state != 'retrying':
+                del self.pending[(message_id, device_id)]
+            updated.append(delivery)
+        return updated
+
+
+class DatagramHandler:
+    # Handling of the discovery, status and button ports, whatever the datagrams arrive through.
+    # Everything here runs on one thread, the registry's single writer. Subclasses send the
+    # connected pings and decide what a button press does. With a namespace ("studio-b/") device
+    # ids from this network can't clash with the same ids on another.
+    def __init__(self, registry, metrics=None, clock=time.monotonic,
+                 ports=(DISCOVERY_PORT, STATUS_PORT, BUTTON_PORT), namespace=''):
+        self.registry = registry
+        self.metrics = metrics if metrics is not None else Metrics(ports, namespace.rstrip('/'))
+        self.clock = clock
+        self.metrics.clock = clock
+        self.namespace = namespace
+        self.discovery_port, self.status_port, self.button_port = ports
+        self.liveness = LivenessTracker()
+        self.prompts = PromptTracker(registry)
+        self.handlers = {self.discovery_port: self.handle_discovery, self.status_port: self.handle_status,
+                         self.button_port: self.handle_button}
+        self.pending_changed = set()
+        self.pending_online = set()
+        self.pending_offline = set()
+        self.last_flush = 0.0
+        self.relay = None  # {mixer input: status} in relay mode, where device ids are the camera numbers
+
+    def send_datagram(self, payload, ip):
+        raise NotImplementedError
+
+    def button_pressed_by(self, dev_id):
+        raise NotImplementedError
+
+    def prompt_updated(self, delivery):
+        raise NotImplementedError
+
+    def send_connected_ping(self, ip, dev_id=None):
+        if self.relay is not None and dev_id is not None:
+            # the tally rides along, so a device that just booted or missed a change catches up
+            self.send_datagram(build_relay(self.relay_status(dev_id), True), ip)
+        else:
+            self.send_datagram(CONNECTED_PING, ip)
+
+    def relay_status(self, dev_id):
+        return self.relay.get(device_key(dev_id)[1], 0)
+
+    def relay_tally(self, statuses):
+        # statuses of mixer inputs 1, 2, ...; only devices whose tally changed are sent to, and all
+        # of them go out together at the end of this pass
+        previous = self.relay or {}
+        self.relay = dict(enumerate(statuses, 1))
+        for camera in set(previous) | set(self.relay):
+            status = self.relay.get(camera, 0)
+            if previous.get(camera, 0) != status:
+                record = self.registry.get(self.namespace + str(camera))
+                if record is not None:
+                    self.send_datagram(build_relay(status), record.ip_address)
+
+    def start_prompt(self, message_id, text, device_ids, broadcast=None):
+        payload = build_prompt(message_id, text)
+        deliveries = self.prompts.start(message_id, payload, device_ids, self.clock())
+        if broadcast is not None:
+            self.send_datagram(payload, broadcast)
+        else:
+            for ip in {delivery.ip for delivery in deliveries}:
+                self.send_datagram(payload, ip)
+        for delivery in deliveries:
+            self.prompt_updated(delivery)
+
+    def deliver(self, port, data, addr):
+        handler = self.handlers.get(port)
+        if handler is not None:
+            self.metrics.packets[port] += 1
+            handler(data, addr)
+
+    def handle_discovery(self, data, addr):
+        if len(data) == 1:
+            dev_id = self.namespace + str(data[0])
+            now = self.clock()
+            changed = self.registry.record_discovery(dev_id, addr[0], now)
+            if changed:
+                self.pending_changed.add(dev_id)
+            came_online = self.mark_seen(dev_id, now)
+            # new, moved or returning devices are acked at once, healthy ones at most every ACK_INTERVAL
+            record = self.registry.get(dev_id)
+            if changed or came_online or now - record.last_ack >= ACK_INTERVAL:
+                record.last_ack = now
+                self.send_connected_ping(addr[0], dev_id)
+        else:
+            self.metrics.malformed[self.discovery_port] += 1
+
+    def handle_status(self, data, addr):
+        try:
+            dev_id, status, sequence, battery, rssi = parse_status(data)
+            dev_id = self.namespace + dev_id
+        except (ValueError, KeyError, TypeError):
+            if not self.handle_ack(data, addr):
+                self.metrics.malformed[self.status_port] += 1
+            return
+        now = self.clock()
+        if self.registry.is_stale(dev_id, sequence, now):
+            # reordered or duplicated datagram, a newer state is already applied
+            self.metrics.stale_packets += 1
+            return
+        # the registry always holds the latest state, subscribers only get it at the next flush
+        if self.registry.record_status(dev_id, addr[0], status, now, sequence, battery, rssi):
+            self.pending_changed.add(dev_id)
+        self.mark_seen(dev_id, now)
+        if self.relay is not None and status != self.relay_status(dev_id):
+            # the device reports a tally the mixer doesn't have, e.g. a relayed change got lost
+            self.send_datagram(build_relay(self.relay_status(dev_id)), addr[0])
+
+    def handle_ack(self, data, addr):
+        try:
+            message_id, dev_id = parse_ack(data)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        record = self.registry.get(self.namespace + dev_id) if dev_id is not None else self.registry.find_by_ip(addr[0])
+        if record is not None:
+            delivery = self.prompts.acked(message_id, record, self.clock())
+            if delivery is not None:
+                self.prompt_updated(delivery)
+        return True
+
+    def handle_button(self, data, addr):
+        if len(data) == 1:
+            dev_id = self.namespace + str(data[0])
+            now = self.clock()
+            if dev_id in self.registry:
+                self.registry.record_button(dev_id, now)
+                self.mark_seen(dev_id, now)
+            self.button_pressed_by(dev_id)
+        else:
+            self.metrics.malformed[self.button_port] += 1
+
+    def mark_seen(self, dev_id, now):
+        if self.liveness.seen(dev_id, now):
+            self.pending_offline.discard(dev_id)
+            self.pending_online.add(dev_id)
+            if self.registry.check_in(dev_id):
+                self.pending_changed.add(dev_id)
+            return True
+        return False
+
+    def expire_devices(self, now):
+        for dev_id in self.liveness.expire(now):
+            self.pending_online.discard(dev_id)
+            self.pending_offline.add(dev_id)
+
+    def flush_changes(self):
+        changed = [self.registry.get(dev_id).snapshot() for dev_id in self.pending_changed]
+        online, offline = list(self.pending_online), list(self.pending_offline)
+        self.pending_changed.clear()
+        self.pending_online.clear()
+        self.pending_offline.clear()
+        self.last_flush = self.clock()
+        self.metrics.batches_sent += 1
+        self.registry.notify(changed, online, offline)
+
+    def has_pending(self):
+        return bool(self.pending_changed or self.pending_online or self.pending_offline)
+
+    def next_deadline(self):
+        # when tick() next has work: a device timing out, a prompt to retransmit or changes to flush
+        deadline = self.liveness.next_deadline()
+        prompt_at = self.prompts.next_deadline()
+        if prompt_at is not None:
+            deadline = prompt_at if deadline is None else min(deadline, prompt_at)
+        if self.has_pending():
+            flush_at = self.last_flush + STATUS_FLUSH_INTERVAL
+            deadline = flush_at if deadline is None else min(deadline, flush_at)
+        return deadline
+
+    def tick(self, now):
+        self.expire_devices(now)
+        for delivery in self.prompts.expire(now):
+            if delivery.state == 'retrying':
+                self.send_datagram(delivery.payload, delivery.ip)
+            self.prompt_updated(delivery)
+        if self.has_pending() and now - self.last_flush >= STATUS_FLUSH_INTERVAL:
+            self.flush_changes()
+
+
+class RegistryView:
+    # Read-only merge of several networks for the GUI, dashboard and exporters. Device ids are
+    # unique across networks thanks to the namespaces; each lookup goes to the owning network.
+    def __init__(self, handlers):
+        self.handlers = {handler.namespace: handler for handler in handlers}
+
+    def handler_for(self, device_id):
+        return self.handlers.get(device_id[:device_id.rfind('/') + 1])
+
+    def __contains__(self, device_id):
+        return self.get(device_id) is not None
+
+    def __len__(self):
+        return sum(len(handler.registry) for handler in self.handlers.values())
+
+    @property
+    def devices(self):
+        devices = {}
+        for handler in self.handlers.values():
+            devices.update(handler.registry.devices)
+        return devices
+
+    def get(self, device_id):
+        handler = self.handler_for(device_id)
+        return None if handler is None else handler.registry.get(device_id)
+
+    def snapshot(self):
+        return [entry for handler in self.handlers.values() for entry in handler.registry.snapshot()]
+
+    def subscribe(self, callback):
+        for handler in self.handlers.values():
+            handler.registry.subscribe(callback)
+
+    def is_online(self, device_id):
+        # stands in for a LivenessTracker where a single network's one is expected
+        handler = self.handler_for(device_id)
+        return handler is not None and handler.liveness.is_online(device_id)